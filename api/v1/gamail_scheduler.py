@@ -1,6 +1,10 @@
 from fastapi import APIRouter
 from pydantic import BaseModel
-from utils.APScheduler import start_user_scheduler, stop_user_scheduler
+from utils.APScheduler import (
+    start_user_scheduler,
+    stop_user_scheduler,
+    sync_dispatcher,
+)
 from models.jobs import jobs
 
 router = APIRouter(tags=["Scheduler"])
@@ -45,3 +49,9 @@ async def stop_job(payload: EmailJobStopRequest):
 async def job_status(user_id: str):
     doc = await jobs.find_one({"user_id": user_id})
     return {"running": bool(doc and doc.get("is_sync_running"))}
+
+
+@router.get("/email-job-metrics")
+async def job_metrics():
+    """Queue depth, lag and throughput of the shared sync worker pool."""
+    return sync_dispatcher.stats()
@@ -7,6 +7,7 @@ from utils.followup_generator import generate_followups
 from models.contact import contacts
 from bson import ObjectId
 from utils.qouta import try_consume_quota
+from utils.llm_gateway import set_llm_tenant
 
 
 router = APIRouter(tags=["Sequence"])
@@ -36,6 +37,7 @@ async def generate_sequence(data: GenerateSequenceRequest):
             )
 
         # ---- Using agent to generate follow-ups ----
+        set_llm_tenant(data.user_id)
         followups = await generate_followups(
             contact, data.email_body, num=len(data.schedule_days)
         )
@@ -0,0 +1,58 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+import base64
+import hmac
+import json
+import os
+from dotenv import load_dotenv
+from gmail_service import find_user_by_gmail_address
+from utils.APScheduler import trigger_user_sync
+
+load_dotenv()
+
+# Shared secret configured on the Pub/Sub push subscription URL (?token=...).
+# Required: without it every push is rejected.
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN")
+
+router = APIRouter(tags=["Scheduler"])
+
+
+class PubSubMessage(BaseModel):
+    data: str
+    messageId: str | None = None
+    publishTime: str | None = None
+
+
+class PubSubPushRequest(BaseModel):
+    message: PubSubMessage
+    subscription: str | None = None
+
+
+@router.post("/gmail/push")
+async def gmail_push(payload: PubSubPushRequest, token: str | None = None):
+    """
+    Pub/Sub push endpoint for Gmail watch notifications.
+
+    The message data is base64 JSON like {"emailAddress": ..., "historyId": ...}.
+    Any 2xx acks the message, so payloads we can't use are acked and ignored
+    instead of being redelivered forever.
+    """
+    if not GMAIL_PUSH_TOKEN:
+        raise HTTPException(status_code=503, detail="Push ingestion is not configured")
+    if not token or not hmac.compare_digest(token, GMAIL_PUSH_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid push token")
+
+    try:
+        notification = json.loads(base64.b64decode(payload.message.data))
+        email_address = notification["emailAddress"]
+    except (ValueError, KeyError, TypeError):
+        return {"status": "ignored", "reason": "malformed notification"}
+
+    user_id = await find_user_by_gmail_address(email_address)
+    if not user_id:
+        return {"status": "ignored", "reason": "unknown mailbox"}
+
+    if not trigger_user_sync(user_id):
+        return {"status": "ignored", "reason": "sync not running"}
+
+    return {"status": "queued", "user_id": user_id}
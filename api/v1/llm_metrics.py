@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+import hmac
+import os
+from dotenv import load_dotenv
+from utils.llm_metrics import llm_metrics
+from utils.llm_cache import llm_cache
+from utils.llm_gateway import gateway_stats
+from utils.reply_validators import validator_stats
+from utils.singleflight import llm_flight, serp_flight
+from utils.regex_junk_detection import junk_engine
+from utils.bulk_mail_filter import bulk_filter_stats
+from utils.sender_reputation import sender_reputation
+
+load_dotenv()
+
+# Ops token for the metrics endpoints (per-user ids, costs and senders):
+# scrapers send "Authorization: Bearer <token>". Unset disables them.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def require_metrics_token(authorization: str | None = Header(default=None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=503, detail="Metrics are not configured")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token, METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid metrics token")
+
+
+router = APIRouter(tags=["Metrics"], dependencies=[Depends(require_metrics_token)])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Per-agent LLM runs, latency, tokens and cost in Prometheus text format."""
+    return PlainTextResponse(
+        llm_metrics.prometheus(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@router.get("/llm-metrics")
+async def llm_metrics_summary():
+    """JSON summary of LLM usage per agent and per user, plus cache/gateway state."""
+    return {
+        **llm_metrics.summary(),
+        "validators": validator_stats(),
+        "junk_rules": junk_engine.stats(),
+        "bulk_filter": bulk_filter_stats(),
+        "sender_reputation": sender_reputation.stats(),
+        "cache": llm_cache.stats(),
+        "gateway": gateway_stats(),
+        "singleflight": {"llm": llm_flight.stats(), "serpapi": serp_flight.stats()},
+    }
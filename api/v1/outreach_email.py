@@ -1,9 +1,12 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, HttpUrl, Field
 from typing import Optional, Literal
-from utils.email_generator import generate_cold_email
+from utils.email_generator import generate_cold_email, stream_cold_email
 from utils.linkedin_scraper import guardrail_linkedin_scrape
 from utils.qouta import try_consume_quota
+from utils.llm_gateway import set_llm_tenant
+from utils.sse import sse_event, SSE_HEADERS
 
 router = APIRouter(tags=["Cold Email"])
 
@@ -39,12 +42,13 @@ async def generate_email(data: GenerateEmailRequest):
             )
 
         # STEP 3: Scrape LinkedIn with guardrail + caching
-        linkedin_data = guardrail_linkedin_scrape(data.linkedin_url)
+        linkedin_data = await guardrail_linkedin_scrape(data.linkedin_url)
         if linkedin_data["status"] != "success":
             raise HTTPException(status_code=400, detail=linkedin_data["message"])
 
         user_data = linkedin_data["data"]
 
+        set_llm_tenant(data.user_id)
         result = await generate_cold_email(
             linkedin_url=data.linkedin_url,
             role=user_data["headline"],
@@ -60,3 +64,63 @@ async def generate_email(data: GenerateEmailRequest):
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/generate-email/stream")
+async def generate_email_stream(data: GenerateEmailRequest):
+    """
+    Server-sent events version of /generate-email:
+    `status` → `delta` ({variation, text}) ... → `done` (same shape as
+    EmailResponse) or `error` ({detail}).
+    """
+    if "linkedin.com/in/" not in data.linkedin_url:
+        raise HTTPException(status_code=400, detail="Invalid LinkedIn URL format")
+
+    consumed = await try_consume_quota(data.user_id, "contactsImported", 1)
+    if not consumed:
+        raise HTTPException(
+            status_code=403,
+            detail="Email generation limit reached. Upgrade to Pro to generate more outreach emails.",
+        )
+
+    async def events():
+        # first byte goes out before the LinkedIn lookup
+        yield sse_event("status", {"stage": "researching"})
+        try:
+            linkedin_data = await guardrail_linkedin_scrape(data.linkedin_url)
+            if linkedin_data["status"] != "success":
+                yield sse_event("error", {"detail": linkedin_data["message"]})
+                return
+
+            user_data = linkedin_data["data"]
+            yield sse_event("status", {"stage": "writing"})
+
+            set_llm_tenant(data.user_id)
+            variations = []
+            async for event in stream_cold_email(
+                linkedin_url=data.linkedin_url,
+                role=user_data["headline"],
+                website=data.website,
+                tone=data.tone,
+                about=user_data["about"],
+                user_id=data.user_id,
+            ):
+                if event["type"] == "delta":
+                    yield sse_event(
+                        "delta", {"variation": event["variation"], "text": event["text"]}
+                    )
+                else:
+                    variations = event["variations"]
+
+            yield sse_event(
+                "done",
+                {
+                    "email": data.email,
+                    "variation_1": variations[0] if variations else "",
+                    "variation_2": variations[1] if len(variations) > 1 else None,
+                },
+            )
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
@@ -1,13 +1,30 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from agents import OutputGuardrailTripwireTriggered
 from pydantic import BaseModel
 from bson import ObjectId
 from models.hard_email import hard_emails
-from gmail_service import get_gmail_service, send_email_reply
-from utils.hard_email_replyer import generate_reply
+from gmail_service import (
+    get_gmail_service,
+    send_email_reply_async,
+    build_reply_message,
+    send_message_async,
+    get_thread_last_message_id_async,
+)
+from utils.hard_email_replyer import (
+    generate_reply,
+    draft_reply,
+    stream_reply,
+    check_reply,
+)
+from agent_core import SPECULATIVE_GUARDRAILS, SPECULATIVE_MAX_ATTEMPTS
+import asyncio
 import os
+from utils.llm_gateway import set_llm_tenant
+from utils.sse import sse_event, SSE_HEADERS
 from motor.motor_asyncio import AsyncIOMotorClient
 import re
-from models.users import users
+from models.users import get_user_profile
 from utils.analytics_service import update_analytics
 
 
@@ -20,29 +37,103 @@ class RefineEmailRequest(BaseModel):
     refined_body: str
 
 
-@router.post("/refine-hard-email")
-async def resend_hard_email(req: RefineEmailRequest):
-    # 1. Fetch hard email from DB
+async def _send_speculative(req, email_doc, your_name, sender_name, clean_sender):
+    """
+    Draft without the guardrail, then check each draft while the Gmail service,
+    thread lookup and MIME message are prepared. Only a passing draft is sent.
+    Returns the sent reply, or None if every draft tripped the guardrail.
+    """
+    thread_id = email_doc.get("threadId")
+    service_task = asyncio.create_task(get_gmail_service(req.user_id))
+    guardrail = None
+    in_reply_to = None
+
+    try:
+        reply = await draft_reply(req.refined_body, your_name, sender_name)
+        for attempt in range(SPECULATIVE_MAX_ATTEMPTS):
+            guardrail = asyncio.create_task(check_reply(reply, your_name, sender_name))
+
+            # prepare the send while the guardrail runs
+            service = await service_task
+            if attempt == 0 and thread_id:
+                try:
+                    in_reply_to = await get_thread_last_message_id_async(
+                        service, req.user_id, thread_id
+                    )
+                except Exception as e:
+                    print(f"⚠️ Thread lookup failed, sending unthreaded: {e}")
+            message = build_reply_message(
+                clean_sender, email_doc.get("subject"), reply, thread_id, in_reply_to
+            )
+
+            if await guardrail:
+                await send_message_async(service, req.user_id, message)
+                return reply
+
+            print(f"⚠️ Reply tripped the guardrail (attempt {attempt + 1})")
+            if attempt < SPECULATIVE_MAX_ATTEMPTS - 1:
+                reply = await draft_reply(req.refined_body, your_name, sender_name)
+        return None
+    finally:
+        service_task.cancel()
+        if guardrail is not None:
+            guardrail.cancel()
+
+
+async def _load_hard_email(req: RefineEmailRequest):
+    """Return (email_doc, profile, sender_name, clean_sender) or raise 404."""
     email_doc = await hard_emails.find_one(
         {"_id": ObjectId(req.email_id), "status": "hard"}
     )
     if not email_doc:
         raise HTTPException(status_code=404, detail="Hard email not found")
 
-    user_data = await users.find_one({"_id": ObjectId(req.user_id)})
+    profile = await get_user_profile(req.user_id)
 
-    if not user_data:
+    if not profile:
         raise HTTPException(status_code=404, detail="User not found")
 
     sender = email_doc.get("sender")
-    subject = email_doc.get("subject")
     # extract sender's name
     sender_name = sender.split("<")[0].strip()
 
+    match = re.search(r"<(.+?)>", sender)
+    # Extract the email address
+    clean_sender = match.group(1) if match else sender.strip()
+    return email_doc, profile, sender_name, clean_sender
+
+
+@router.post("/refine-hard-email")
+async def resend_hard_email(req: RefineEmailRequest):
+    set_llm_tenant(req.user_id)
+    # 1. Fetch hard email from DB
+    email_doc, profile, sender_name, clean_sender = await _load_hard_email(req)
+    subject = email_doc.get("subject")
+
+    if SPECULATIVE_GUARDRAILS:
+        # 2+3. Generate, validate and send with the guardrail run in parallel
+        try:
+            refined_reply = await _send_speculative(
+                req, email_doc, profile.display_name, sender_name, clean_sender
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Email send failed: {str(e)}")
+        if refined_reply is None:
+            raise HTTPException(
+                status_code=422, detail="Could not generate a valid reply, try again"
+            )
+        # ✅ Update analytics
+        await update_analytics(req.user_id, "autoReplied", 1)
+        await hard_emails.update_one(
+            {"_id": ObjectId(req.email_id)},
+            {"$set": {"status": "replied", "snippet": refined_reply}},
+        )
+        return {"message": "Hard email successfully re-send", "reply": refined_reply}
+
     # 2. Drop refined email to AI Agent
     try:
         refined_reply = await generate_reply(
-            req.refined_body, user_data["name"], sender_name
+            req.refined_body, profile.display_name, sender_name
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Email agent failed: {str(e)}")
@@ -51,11 +142,9 @@ async def resend_hard_email(req: RefineEmailRequest):
     try:
         service = await get_gmail_service(req.user_id)
 
-        match = re.search(r"<(.+?)>", sender)
-        # Extract the email address
-        clean_sender = match.group(1) if match else sender.strip()
-
-        send_email_reply(service, clean_sender, subject, refined_reply)
+        await send_email_reply_async(
+            service, req.user_id, clean_sender, subject, refined_reply
+        )
         # ✅ Update analytics
         await update_analytics(req.user_id, "autoReplied", 1)
 
@@ -69,3 +158,57 @@ async def resend_hard_email(req: RefineEmailRequest):
     )
 
     return {"message": "Hard email successfully re-send", "reply": refined_reply}
+
+
+@router.post("/refine-hard-email/stream")
+async def resend_hard_email_stream(req: RefineEmailRequest):
+    """
+    Server-sent events version of /refine-hard-email: `delta` ({text}) while
+    the reply is written, then `done` ({message, reply}) once it passed the
+    guardrail and was sent, or `error` ({detail}).
+    """
+    set_llm_tenant(req.user_id)
+    email_doc, profile, sender_name, clean_sender = await _load_hard_email(req)
+
+    async def events():
+        # build the Gmail service while the reply streams
+        service_task = asyncio.create_task(get_gmail_service(req.user_id))
+        try:
+            parts = []
+            try:
+                async for text in stream_reply(
+                    req.refined_body, profile.display_name, sender_name
+                ):
+                    parts.append(text)
+                    yield sse_event("delta", {"text": text})
+            except OutputGuardrailTripwireTriggered:
+                yield sse_event(
+                    "error", {"detail": "Could not generate a valid reply, try again"}
+                )
+                return
+            except Exception as e:
+                yield sse_event("error", {"detail": f"Email agent failed: {str(e)}"})
+                return
+
+            refined_reply = "".join(parts)
+            try:
+                service = await service_task
+                await send_email_reply_async(
+                    service, req.user_id, clean_sender, email_doc.get("subject"), refined_reply
+                )
+                await update_analytics(req.user_id, "autoReplied", 1)
+            except Exception as e:
+                yield sse_event("error", {"detail": f"Gmail send failed: {str(e)}"})
+                return
+
+            await hard_emails.update_one(
+                {"_id": ObjectId(req.email_id)},
+                {"$set": {"status": "replied", "snippet": refined_reply}},
+            )
+            yield sse_event(
+                "done", {"message": "Hard email successfully re-send", "reply": refined_reply}
+            )
+        finally:
+            service_task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
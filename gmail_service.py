@@ -1,15 +1,28 @@
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import asyncio
 import base64
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
 from email.mime.text import MIMEText
 import os
 from dotenv import load_dotenv
-from bson import ObjectId
 from database.mongo import db
-from models.users import users
+from models.users import get_user_profile, invalidate_user_profile
+from models.processed_message import filter_unprocessed, mark_processed
+from utils.gmail_executor import (
+    GMAIL_MAX_RETRIES,
+    is_retryable,
+    retry_delay,
+    run_gmail_call,
+    run_gmail_call_once,
+)
+from utils.bulk_mail_filter import BULK_HEADERS
 
 load_dotenv()
 
@@ -18,115 +31,380 @@ meta_collection = db["gmail_meta"]
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 
+# Pub/Sub topic Gmail publishes mailbox changes to (push ingestion mode)
+GMAIL_PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+
+# Gmail system label for the "Primary" inbox tab
+PRIMARY_LABEL = "CATEGORY_PERSONAL"
+
+# Gmail accepts up to 100 calls per batch but throttles large batches,
+# 50 is the documented sweet spot
+GMAIL_BATCH_LIMIT = 50
+# messages.batchModify accepts up to 1000 ids per call
+GMAIL_BATCH_MODIFY_LIMIT = 1000
+
+# Per-user credentials + built Gmail services, most recently used last
+GMAIL_SERVICE_CACHE_SIZE = int(os.getenv("GMAIL_SERVICE_CACHE_SIZE", "500"))
+_service_cache = OrderedDict()
+
+# Refresh access tokens a little before Google actually expires them
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
 SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
     "https://www.googleapis.com/auth/gmail.send",
 ]
 
 
+def _token_needs_refresh(creds: Credentials) -> bool:
+    # creds.expiry is a naive UTC datetime
+    if not creds.token or not creds.expiry:
+        return True
+    return creds.expiry - TOKEN_REFRESH_MARGIN <= datetime.utcnow()
+
+
+def invalidate_gmail_service(user_id: str):
+    """Drop the cached credentials/service for a user (e.g. after re-auth)."""
+    _service_cache.pop(str(user_id), None)
+
+
 async def get_gmail_service(user_id: str):
-    # Fetch user refresh token from DB
-    id = ObjectId(user_id)
-    user = await users.find_one({"_id": id})
+    """
+    Return a Gmail service for the user.
+
+    Credentials and built services are cached per user (LRU, bounded by
+    GMAIL_SERVICE_CACHE_SIZE). The access token is only refreshed when it is
+    missing or close to expiry, and the cache entry is rebuilt whenever the
+    user's refresh_token changes.
+    """
+    # Fetch user refresh token (cached profile)
+    profile = await get_user_profile(user_id)
 
-    if not user:
+    if not profile:
         raise Exception(f"User {user_id} not found in DB")
 
-    refresh_token = user.get("refresh_token")
+    refresh_token = profile.refresh_token
     if not refresh_token:
         raise Exception("No refresh token found for this user")
 
-    creds = Credentials(
-        None,  # no access token saved
-        refresh_token=refresh_token,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        scopes=SCOPES,
-    )
-
-    # Always refresh access token
-    creds.refresh(Request())
+    key = str(user_id)
+    cached = _service_cache.get(key)
+    if cached and cached["refresh_token"] != refresh_token:
+        invalidate_gmail_service(key)
+        cached = None
+
+    if cached is None:
+        creds = Credentials(
+            None,  # no access token saved
+            refresh_token=refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=GOOGLE_CLIENT_ID,
+            client_secret=GOOGLE_CLIENT_SECRET,
+            scopes=SCOPES,
+        )
+        # static discovery document ships with google-api-python-client,
+        # so building the service never hits the network
+        service = build(
+            "gmail",
+            "v1",
+            credentials=creds,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+        cached = {"refresh_token": refresh_token, "creds": creds, "service": service}
+        _service_cache[key] = cached
+        while len(_service_cache) > GMAIL_SERVICE_CACHE_SIZE:
+            _service_cache.popitem(last=False)
+    else:
+        _service_cache.move_to_end(key)
+
+    # Refresh access token only when it is about to expire
+    if _token_needs_refresh(cached["creds"]):
+        try:
+            await run_gmail_call(user_id, cached["creds"].refresh, Request())
+        except RefreshError:
+            # revoked / replaced refresh token: read the user again next time
+            # so a re-authorization is picked up without waiting for the TTL
+            invalidate_gmail_service(key)
+            invalidate_user_profile(user_id)
+            raise
 
     # Return Gmail service
-    return build("gmail", "v1", credentials=creds)
+    return cached["service"]
 
 
 # ---------- Fetch Latest Email using Gmail API ----------
+class HistoryExpiredError(Exception):
+    """Raised when the stored historyId is too old for users.history.list."""
+
+
+def _metadata_request(service, message_id: str):
+    return (
+        service.users()
+        .messages()
+        .get(
+            userId="me",
+            id=message_id,
+            format="metadata",
+            # bulk headers ride along for the pre-filter in process_email
+            metadataHeaders=["Subject", "From", *BULK_HEADERS],
+        )
+    )
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _fetch_metadata_pass(service, message_ids: list[str]):
+    """
+    One pass over the Gmail batch endpoint, grouped by GMAIL_BATCH_LIMIT.
+
+    Returns (results, retry_ids, failed_ids). Messages deleted since they
+    were listed (404) are in neither list, there is nothing left to fetch.
+    """
+    results, retry, failed = {}, [], []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+        elif is_retryable(exception):
+            retry.append(request_id)
+        elif isinstance(exception, HttpError) and exception.resp.status == 404:
+            print(f"⚠️ Message {request_id} no longer exists, skipping")
+        else:
+            print(f"⚠️ Failed to fetch message {request_id}: {exception}")
+            failed.append(request_id)
+
+    for chunk in _chunks(message_ids, GMAIL_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in chunk:
+            batch.add(_metadata_request(service, message_id), request_id=message_id)
+        batch.execute()
+    return results, retry, failed
+
+
+async def fetch_messages_metadata(service, user_id: str, message_ids: list[str]):
+    """
+    Fetch metadata for many messages through the Gmail batch endpoint.
+
+    Items (or whole batches) that fail with 429/5xx are retried up to
+    GMAIL_MAX_RETRIES times with backoff; this is the only retry layer.
+
+    Returns (message_id -> metadata, ids that could not be fetched), so the
+    caller can keep its sync cursor before the failed ones.
+    """
+    results, failed = {}, []
+    pending = list(message_ids)
+    attempt = 0
+
+    while pending:
+        error = None
+        try:
+            fetched, retry, errors = await run_gmail_call_once(
+                user_id, _fetch_metadata_pass, service, pending
+            )
+            results.update(fetched)
+            failed += errors
+        except HttpError as e:
+            if not is_retryable(e):
+                raise
+            error, retry = e, pending
+
+        if not retry:
+            break
+        if attempt >= GMAIL_MAX_RETRIES:
+            print(f"⚠️ Giving up on {len(retry)} messages after {attempt} retries")
+            failed += retry
+            break
+
+        delay = retry_delay(error, attempt)
+        attempt += 1
+        await asyncio.sleep(delay)
+        pending = retry
+
+    return results, failed
+
+
+_BULK_HEADER_NAMES = {name.lower() for name in BULK_HEADERS}
+
+
+def _to_email(msg_data: dict) -> dict:
+    headers = {
+        h["name"]: h["value"] for h in msg_data.get("payload", {}).get("headers", [])
+    }
+    return {
+        "id": msg_data["id"],
+        "threadId": msg_data.get("threadId"),
+        "subject": headers.get("Subject", ""),
+        "sender": headers.get("From", ""),
+        "snippet": msg_data.get("snippet", ""),
+        "historyId": int(msg_data.get("historyId", 0)),
+        "labelIds": msg_data.get("labelIds", []),
+        # header names are case-insensitive, senders don't agree on casing
+        "headers": {
+            name: value
+            for name, value in headers.items()
+            if name.lower() in _BULK_HEADER_NAMES
+        },
+    }
+
+
+def _list_added_message_ids(service, start_history_id: int):
+    """
+    Walk users.history.list from start_history_id and collect the primary
+    inbox messages that were added since then, oldest first.
+
+    Returns ([(message_id, history_record_id)], mailbox_history_id). Raises
+    HistoryExpiredError when Gmail no longer has history for
+    start_history_id (HTTP 404).
+    """
+    added_messages = []
+    seen = set()
+    latest_history_id = start_history_id
+    page_token = None
+
+    while True:
+        try:
+            response = (
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    labelId="INBOX",
+                    pageToken=page_token,
+                )
+                .execute()
+            )
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpiredError(str(e))
+            raise
+
+        latest_history_id = max(
+            latest_history_id, int(response.get("historyId", 0))
+        )
+
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added.get("message", {})
+                labels = message.get("labelIds", [])
+                # only primary tab, same as the q="category:primary" full sync
+                if PRIMARY_LABEL not in labels:
+                    continue
+                if message["id"] not in seen:
+                    seen.add(message["id"])
+                    added_messages.append((message["id"], int(record["id"])))
+
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+    return added_messages, latest_history_id
+
+
+def _list_recent_message_ids(service, max_results: int):
+    # read the mailbox historyId *before* listing so nothing that arrives in
+    # between is skipped by the next incremental sync
+    profile = service.users().getProfile(userId="me").execute()
+    results = (
+        service.users()
+        .messages()
+        .list(userId="me", maxResults=max_results, q="category:primary")
+        .execute()
+    )
+    message_ids = [msg["id"] for msg in results.get("messages", [])]
+    return message_ids, int(profile.get("historyId", 0))
+
+
 async def fetch_recent_emails(service, user_id: str, max_results: int):
     """
     Fetch the most recent emails for a specific tenant/user, avoiding duplicates
     using a per-user Gmail historyId stored in MongoDB.
+
+    When a historyId is stored, only the messages added since then are pulled
+    via users.history.list, oldest first and at most max_results per call;
+    the stored historyId only moves past messages that were handled, so the
+    rest are picked up by the next poll. A full list+get resync only happens
+    on the first run or when Gmail reports the stored historyId as expired.
     """
     try:
         # Get last stored historyId for this user
-        last_meta = await meta_collection.find_one({"_id": f"gmail_tracker_{user_id}"})
+        last_meta = await meta_collection.find_one(
+            {"_id": f"gmail_tracker_{user_id}"},
+            {"last_history_id": 1, "processed_ids": {"$slice": 1}},
+        )
         last_history_id = last_meta.get("last_history_id") if last_meta else None
-        seen_ids = set(last_meta.get("processed_ids", [])) if last_meta else set()
 
-        results = (
-            service.users()
-            .messages()
-            .list(userId="me", maxResults=max_results, q="category:primary")
-            .execute()
-        )
+        message_ids = None
+        full_sync = True
+        if last_history_id:
+            try:
+                added_messages, mailbox_history_id = await run_gmail_call(
+                    user_id, _list_added_message_ids, service, int(last_history_id)
+                )
+                message_ids = [m for m, _ in added_messages[:max_results]]
+                full_sync = False
+            except HistoryExpiredError:
+                print(f"⚠️ historyId expired for {user_id}, running full resync")
+
+        if message_ids is None:
+            message_ids, mailbox_history_id = await run_gmail_call(
+                user_id, _list_recent_message_ids, service, max_results
+            )
 
-        messages = results.get("messages", [])
         emails = []
         new_ids = set()
-        latest_history_id = last_history_id or 0  # default to 0 if None
-
-        for msg in messages:
-            if msg["id"] in seen_ids:
-                continue
 
-            msg_data = (
-                service.users()
-                .messages()
-                .get(
-                    userId="me",
-                    id=msg["id"],
-                    format="metadata",
-                    metadataHeaders=["Subject", "From"],
-                )
-                .execute()
-            )
+        # only the candidate ids are looked up, so the read cost per poll
+        # does not grow with the age of the mailbox
+        candidate_ids = message_ids
+        message_ids = await filter_unprocessed(user_id, message_ids)
+        metadata, failed_ids = await fetch_messages_metadata(
+            service, user_id, message_ids
+        )
 
-            headers = {
-                h["name"]: h["value"]
-                for h in msg_data.get("payload", {}).get("headers", [])
-            }
+        for message_id in message_ids:
+            if message_id not in metadata:
+                continue
 
-            history_id = int(msg_data.get("historyId", 0))
+            email = _to_email(metadata[message_id])
 
-            # If we have a last_history_id, skip older messages
-            if last_history_id is not None and history_id <= last_history_id:
+            # On a full resync, skip messages older than what we already synced
+            if (
+                full_sync
+                and last_history_id is not None
+                and email["historyId"] <= last_history_id
+            ):
                 continue
 
-            emails.append(
-                {
-                    "id": msg["id"],
-                    "subject": headers.get("Subject", ""),
-                    "sender": headers.get("From", ""),
-                    "snippet": msg_data.get("snippet", ""),
-                    "historyId": history_id,
-                }
-            )
-
-            # Add to seen IDs and track latest historyId
-            new_ids.add(msg["id"])
-            latest_history_id = max(latest_history_id, history_id)
+            emails.append(email)
+            new_ids.add(message_id)
 
         # Update Mongo with latest historyId and processed IDs per user
-        if new_ids:
-            await meta_collection.update_one(
-                {"_id": f"gmail_tracker_{user_id}"},
-                {
-                    "$set": {"last_history_id": latest_history_id},
-                    "$addToSet": {"processed_ids": {"$each": list(new_ids)}},
-                },
-                upsert=True,
-            )
+        await mark_processed(user_id, list(new_ids))
+        if failed_ids:
+            print(f"⚠️ {len(failed_ids)} messages not fetched for {user_id}")
+        if full_sync:
+            # keep the old cursor so failed messages are listed again
+            cursor = last_history_id if failed_ids else mailbox_history_id
+        else:
+            # stop just before the first message that was not handled: past
+            # max_results or failed to fetch. Overlap is harmless, processed
+            # ids are filtered out.
+            handled = set(candidate_ids) - set(failed_ids)
+            pending = [record_id for m, record_id in added_messages if m not in handled]
+            cursor = min(pending) - 1 if pending else mailbox_history_id
+        update = {"$set": {"last_history_id": cursor}}
+        if last_meta and "processed_ids" in last_meta:
+            # drop the legacy unbounded array once the user is migrated
+            update["$unset"] = {"processed_ids": ""}
+        await meta_collection.update_one(
+            {"_id": f"gmail_tracker_{user_id}"}, update, upsert=True
+        )
 
         return emails
 
@@ -138,26 +416,180 @@ def move_to_trash(service, message_id):
     service.users().messages().trash(userId="me", id=message_id).execute()
 
 
-def send_email_reply(service, to_email, subject, message_body):
-    """Send an email reply using Gmail API."""
+def build_reply_message(to_email, subject, message_body, thread_id=None, in_reply_to=None):
+    """Build the messages.send body for a reply, threaded when ids are given."""
     message = MIMEText(message_body)
     message["to"] = to_email
     message["subject"] = (
         "Re: " + subject
     )  # why Re? because it's a reply to the original email
+    if in_reply_to:
+        message["In-Reply-To"] = in_reply_to
+        message["References"] = in_reply_to
 
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     body = {"raw": raw_message}
+    if thread_id:
+        body["threadId"] = thread_id
+    return body
+
 
-    sent_message = service.users().messages().send(userId="me", body=body).execute()
+def send_message(service, body):
+    return service.users().messages().send(userId="me", body=body).execute()
+
+
+def send_email_reply(service, to_email, subject, message_body):
+    """Send an email reply using Gmail API."""
+    body = build_reply_message(to_email, subject, message_body)
+    sent_message = send_message(service, body)
     return sent_message
 
 
+def get_thread_last_message_id(service, thread_id):
+    """Message-ID header of the newest message in a thread, for In-Reply-To."""
+    thread = (
+        service.users()
+        .threads()
+        .get(userId="me", id=thread_id, format="metadata", metadataHeaders=["Message-ID"])
+        .execute()
+    )
+    messages = thread.get("messages", [])
+    if not messages:
+        return None
+    headers = messages[-1].get("payload", {}).get("headers", [])
+    return next((h["value"] for h in headers if h["name"].lower() == "message-id"), None)
+
+
 def marked_as_read(service, message_id):
     """Mark an email as read."""
     body = {"removeLabelIds": ["UNREAD"]}
     service.users().messages().modify(userId="me", id=message_id, body=body).execute()
 
 
+def batch_modify_labels(service, message_ids, add_labels=None, remove_labels=None):
+    """Apply the same label change to many messages via messages.batchModify."""
+    for chunk in _chunks(list(message_ids), GMAIL_BATCH_MODIFY_LIMIT):
+        body = {"ids": chunk}
+        if add_labels:
+            body["addLabelIds"] = add_labels
+        if remove_labels:
+            body["removeLabelIds"] = remove_labels
+        service.users().messages().batchModify(userId="me", body=body).execute()
+
+
+def batch_move_to_trash(service, message_ids):
+    batch_modify_labels(service, message_ids, add_labels=["TRASH"])
+
+
+def batch_marked_as_read(service, message_ids):
+    batch_modify_labels(service, message_ids, remove_labels=["UNREAD"])
+
+
+class PendingLabelChanges:
+    """
+    Collects trash / mark-as-read operations during a sync run so they can be
+    sent as a couple of batchModify calls instead of one request per email.
+    """
+
+    def __init__(self):
+        self.trash_ids = []
+        self.read_ids = []
+
+    def move_to_trash(self, message_id):
+        self.trash_ids.append(message_id)
+
+    def marked_as_read(self, message_id):
+        self.read_ids.append(message_id)
+
+    def flush(self, service):
+        if self.trash_ids:
+            batch_move_to_trash(service, self.trash_ids)
+            self.trash_ids = []
+        if self.read_ids:
+            batch_marked_as_read(service, self.read_ids)
+            self.read_ids = []
+
+
+# ---------- Awaitable helpers (run off the event loop) ----------
+async def move_to_trash_async(service, user_id: str, message_id):
+    await run_gmail_call(user_id, move_to_trash, service, message_id)
+
+
+async def send_email_reply_async(service, user_id: str, to_email, subject, message_body):
+    return await run_gmail_call(
+        user_id, send_email_reply, service, to_email, subject, message_body
+    )
+
+
+async def send_message_async(service, user_id: str, body):
+    return await run_gmail_call(user_id, send_message, service, body)
+
+
+async def get_thread_last_message_id_async(service, user_id: str, thread_id):
+    return await run_gmail_call(user_id, get_thread_last_message_id, service, thread_id)
+
+
+async def marked_as_read_async(service, user_id: str, message_id):
+    await run_gmail_call(user_id, marked_as_read, service, message_id)
+
+
+async def flush_label_changes_async(service, user_id: str, label_changes):
+    await run_gmail_call(user_id, label_changes.flush, service)
+
+
+# ---------- Push notifications (users.watch) ----------
+async def start_gmail_watch(service, user_id: str):
+    """
+    Ask Gmail to publish INBOX changes for this mailbox to GMAIL_PUBSUB_TOPIC.
+
+    The mailbox address is stored on the tracker document so the push webhook
+    can map an incoming notification back to the user. A watch expires after
+    7 days and has to be renewed before that.
+    """
+    if not GMAIL_PUBSUB_TOPIC:
+        raise RuntimeError("GMAIL_PUBSUB_TOPIC is not set")
+
+    body = {
+        "topicName": GMAIL_PUBSUB_TOPIC,
+        "labelIds": ["INBOX"],
+        "labelFilterBehavior": "INCLUDE",
+    }
+    watch = await run_gmail_call(
+        user_id, service.users().watch(userId="me", body=body).execute
+    )
+    profile = await run_gmail_call(
+        user_id, service.users().getProfile(userId="me").execute
+    )
+
+    expiration = datetime.utcfromtimestamp(int(watch["expiration"]) / 1000)
+    await meta_collection.create_index("email_address")
+    await meta_collection.update_one(
+        {"_id": f"gmail_tracker_{user_id}"},
+        {
+            "$set": {
+                "user_id": str(user_id),
+                "email_address": profile["emailAddress"].lower(),
+                "watch_expiration": expiration,
+            }
+        },
+        upsert=True,
+    )
+    return expiration
+
+
+async def get_gmail_watch_expiration(user_id: str):
+    meta = await meta_collection.find_one(
+        {"_id": f"gmail_tracker_{user_id}"}, {"watch_expiration": 1}
+    )
+    return meta.get("watch_expiration") if meta else None
+
+
+async def find_user_by_gmail_address(email_address: str):
+    meta = await meta_collection.find_one(
+        {"email_address": email_address.lower()}, {"user_id": 1}
+    )
+    return meta.get("user_id") if meta else None
+
+
 def get_reciever_name(message):
     return message["sender"].split("<")[-1].replace(">", "").strip()
@@ -1,7 +1,11 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from utils.APScheduler import monitor_schedulers
+from utils.APScheduler import monitor_schedulers, sync_dispatcher
 from utils.scheduler import scheduler
+from utils.gmail_executor import shutdown_gmail_executor
+from utils.analytics_service import analytics_buffer
+from utils.llm_gateway import gateway
+from models.users import user_profiles
 
 app = FastAPI()
 
@@ -23,6 +27,16 @@ app.add_middleware(
 def read_root():
     return {"message": "PingGenius Agent API is running 🚀"}
 
+
+@app.on_event("shutdown")
+async def shutdown():
+    await sync_dispatcher.stop()
+    # write out buffered analytics counters before the process exits
+    await analytics_buffer.stop()
+    shutdown_gmail_executor()
+    await gateway.aclose()
+    await user_profiles.stop()
+
     # Use lifespan context manager for startup/shutdown events
 
 
@@ -62,6 +76,8 @@ from api.v1 import (
     refine_hard_emails,
     list_all_email,
     gamail_scheduler,
+    gmail_push,
+    llm_metrics,
     sequence_job_status,
 )
 
@@ -77,3 +93,5 @@ app.include_router(hard_emails.router, prefix="/api/v1")
 app.include_router(refine_hard_emails.router, prefix="/api/v1")
 app.include_router(list_all_email.router, prefix="/api/v1")
 app.include_router(gamail_scheduler.router, prefix="/api/v1")
+app.include_router(gmail_push.router, prefix="/api/v1")
+app.include_router(llm_metrics.router, prefix="/api/v1")
@@ -5,7 +5,13 @@ emails = db["emails"]
 
 
 async def save_email(
-    user_id: str, subject: str, to_email: str, reply: str, status: str
+    user_id: str,
+    subject: str,
+    to_email: str,
+    reply: str,
+    status: str,
+    snippet: str | None = None,
+    reason: str | None = None,
 ):
     emails = db["emails"]
     email_data = {
@@ -16,6 +22,12 @@ async def save_email(
         "status": status,
         "created_at": datetime.utcnow(),
     }
+    # kept as training text for the local classifier
+    if snippet is not None:
+        email_data["snippet"] = snippet
+    # why a pre-filter decided without the LLM, e.g. "list_unsubscribe"
+    if reason is not None:
+        email_data["reason"] = reason
     await emails.insert_one(email_data)
 
 
@@ -6,12 +6,14 @@ from bson import ObjectId
 hard_emails = db["hard_emails"]
 
 
-async def save_hard_email_to_db(email_data: dict, user_id: str):
+async def save_hard_email_to_db(email_data: dict, user_id: str, reason: str | None = None):
     email_data["type"] = "inbound"
     email_data["source"] = "gmail"
     email_data["status"] = "hard"
     email_data["user_id"] = user_id
     email_data["created_at"] = datetime.utcnow()
+    if reason is not None:
+        email_data["reason"] = reason
     await hard_emails.insert_one(email_data)
 
 
@@ -0,0 +1,55 @@
+from datetime import datetime
+import os
+from pymongo import UpdateOne
+from database.mongo import db
+
+# One small document per processed Gmail message, expired by a TTL index so
+# the dedup state stays bounded no matter how old the mailbox is
+processed_messages = db["processed_messages"]
+
+PROCESSED_MESSAGE_TTL_DAYS = int(os.getenv("PROCESSED_MESSAGE_TTL_DAYS", "30"))
+
+_index_ready = False
+
+
+async def ensure_processed_messages_index():
+    global _index_ready
+    if _index_ready:
+        return
+    await processed_messages.create_index(
+        "created_at", expireAfterSeconds=PROCESSED_MESSAGE_TTL_DAYS * 24 * 3600
+    )
+    _index_ready = True
+
+
+def _key(user_id: str, message_id: str) -> str:
+    return f"{user_id}:{message_id}"
+
+
+async def filter_unprocessed(user_id: str, message_ids: list[str]) -> list[str]:
+    """Return the ids from message_ids that were not processed yet, in order."""
+    if not message_ids:
+        return []
+    keys = [_key(user_id, m) for m in message_ids]
+    seen = await processed_messages.distinct("_id", {"_id": {"$in": keys}})
+    seen = set(seen)
+    return [m for m, k in zip(message_ids, keys) if k not in seen]
+
+
+async def mark_processed(user_id: str, message_ids: list[str]):
+    if not message_ids:
+        return
+    await ensure_processed_messages_index()
+    now = datetime.utcnow()
+    # upserts keep this idempotent if a message is seen twice
+    await processed_messages.bulk_write(
+        [
+            UpdateOne(
+                {"_id": _key(user_id, message_id)},
+                {"$setOnInsert": {"user_id": user_id, "created_at": now}},
+                upsert=True,
+            )
+            for message_id in message_ids
+        ],
+        ordered=False,
+    )
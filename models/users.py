@@ -1,7 +1,123 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from collections import OrderedDict
+from dataclasses import dataclass
+from bson import ObjectId
+from utils.singleflight import SingleFlight
+import asyncio
 import os
+import re
+import time
 
 MONGO_URL = os.getenv("MONGO_URL")
 client = AsyncIOMotorClient(MONGO_URL)
 db = client["test"]
-users = db["users"]
\ No newline at end of file
+users = db["users"]
+
+# Profiles are read by every generator, the Gmail service and the scheduler;
+# cache them so one request / sync run reads the user document once
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", "10000"))
+USER_PROFILE_TTL_SECONDS = int(os.getenv("USER_PROFILE_TTL_SECONDS", "300"))
+# Invalidate on writes from other services too (needs a replica set)
+USER_PROFILE_CHANGE_STREAM = os.getenv("USER_PROFILE_CHANGE_STREAM", "false").lower() == "true"
+
+DEFAULT_DISPLAY_NAME = "PingGenius Assistant"
+PROFILE_FIELDS = {"name": 1, "email": 1, "isProUser": 1, "refresh_token": 1}
+
+
+def clean_display_name(name: str | None) -> str:
+    # names are stored with digits, e.g. "Hasnain123siddique" → "Hasnain siddique"
+    cleaned = re.sub(r"\d+", " ", name or "").strip()
+    return cleaned or DEFAULT_DISPLAY_NAME
+
+
+@dataclass(frozen=True)
+class UserProfile:
+    user_id: str
+    name: str | None
+    display_name: str
+    email: str | None
+    is_pro: bool
+    refresh_token: str | None
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "UserProfile":
+        return cls(
+            user_id=str(doc["_id"]),
+            name=doc.get("name"),
+            display_name=clean_display_name(doc.get("name")),
+            email=doc.get("email"),
+            is_pro=bool(doc.get("isProUser")),
+            refresh_token=doc.get("refresh_token"),
+        )
+
+
+class UserProfileCache:
+    def __init__(self, size: int, ttl_seconds: int):
+        self.size = size
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()  # user_id -> (expires_at, UserProfile | None)
+        self._loads = SingleFlight("user_profile")
+        self._watch_task = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id) -> UserProfile | None:
+        key = str(user_id)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if USER_PROFILE_CHANGE_STREAM and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+        # concurrent misses for the same user share one read
+        return await self._loads.do(key, self._load, key)
+
+    async def _load(self, key: str) -> UserProfile | None:
+        doc = await users.find_one({"_id": ObjectId(key)}, PROFILE_FIELDS)
+        profile = UserProfile.from_doc(doc) if doc else None
+        self._entries[key] = (time.monotonic() + self.ttl, profile)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id):
+        """Call after writing name / plan / refresh_token of a user."""
+        self._entries.pop(str(user_id), None)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]
+        while True:
+            try:
+                async with users.watch(pipeline) as stream:
+                    async for change in stream:
+                        self.invalidate(change["documentKey"]["_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # no replica set / stream dropped: drop everything, retry later
+                print(f"⚠️ User profile change stream stopped: {e}")
+                self._entries.clear()
+                await asyncio.sleep(30)
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_profiles = UserProfileCache(USER_PROFILE_CACHE_SIZE, USER_PROFILE_TTL_SECONDS)
+
+
+async def get_user_profile(user_id) -> UserProfile | None:
+    return await user_profiles.get(user_id)
+
+
+def invalidate_user_profile(user_id):
+    user_profiles.invalidate(user_id)
@@ -0,0 +1,95 @@
+# Micro-benchmark of the compiled junk rule engine against the previous
+# per-keyword implementation, on recorded fixtures, e.g.
+#   python scripts/benchmark_junk.py scripts/fixtures/triage_emails.jsonl --repeat 2000
+# --extra-keywords adds synthetic keyword rules to both, to see how each
+# scales with the size of the rule set.
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.regex_junk_detection import (  # noqa: E402
+    BAD_DOMAINS,
+    SPAM_KEYWORDS,
+    is_junk_email,
+    junk_engine,
+)
+
+
+def legacy_is_junk_email(input_text: str, keywords=SPAM_KEYWORDS) -> bool:
+    """The detector as it was before the rule engine, kept for comparison."""
+    subject_match = re.search(r"Subject:\s*(.*)", input_text)
+    from_match = re.search(r"From:\s*(.*)", input_text)
+    body_match = re.search(r"Body:\s*(.*)", input_text, re.DOTALL)
+
+    subject = subject_match.group(1).strip() if subject_match else ""
+    sender = from_match.group(1).strip() if from_match else ""
+    body = body_match.group(1).strip() if body_match else ""
+
+    text = f"{subject} {body}".lower()
+    for kw in keywords:
+        if re.search(kw, text):
+            return True
+    sender = sender.lower()
+    if any(domain in sender for domain in BAD_DOMAINS):
+        return True
+    if text.count("http") > 3:
+        return True
+    if subject.isupper() and len(subject.split()) > 3:
+        return True
+    return False
+
+
+def to_input_text(email: dict) -> str:
+    return (
+        f"Subject: {email['subject']}\nFrom: {email['sender']}\n\n"
+        f"Body: {email.get('snippet', '')} user_id:000000000000000000000000"
+    )
+
+
+def timed(label: str, fn, n: int, baseline: float | None = None) -> float:
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    line = f"{label:28} {elapsed * 1e6 / n:8.2f} µs/email"
+    if baseline:
+        line += f"  ({baseline / elapsed:.1f}x)"
+    print(line)
+    return elapsed
+
+
+def main(path: str, repeat: int, extra_keywords: int):
+    with open(path) as f:
+        fixtures = [json.loads(line) for line in f if line.strip()]
+
+    extra = [f"exclusive deal number {i}" for i in range(extra_keywords)]
+    keywords = SPAM_KEYWORDS + extra
+    junk_engine.load_rules([{"kind": "keyword", "value": kw} for kw in extra])
+    print(f"{len(keywords)} keyword rules")
+    emails = fixtures * repeat
+    texts = [to_input_text(email) for email in emails]
+    n = len(emails)
+
+    mismatches = sum(
+        legacy_is_junk_email(t, keywords) != is_junk_email(t) for t in texts[: len(fixtures)]
+    )
+    print(f"{n} emails, {mismatches} verdict mismatches on the fixtures\n")
+
+    baseline = timed("legacy is_junk_email", lambda: [legacy_is_junk_email(t, keywords) for t in texts], n)
+    timed("is_junk_email (text)", lambda: [is_junk_email(t) for t in texts], n, baseline)
+    timed("score (structured)", lambda: [junk_engine.score(e) for e in emails], n, baseline)
+    timed("score_batch", lambda: junk_engine.score_batch(emails), n, baseline)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the junk rule engine")
+    parser.add_argument("fixtures", help="JSONL with subject, sender, snippet")
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--extra-keywords", type=int, default=0)
+    args = parser.parse_args()
+    main(args.fixtures, args.repeat, args.extra_keywords)
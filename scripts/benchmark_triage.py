@@ -0,0 +1,103 @@
+# Compare the multi-agent triage path with the single-call fast path on
+# recorded fixtures: latency per path and how often both agree, e.g.
+#   python scripts/benchmark_triage.py scripts/fixtures/triage_emails.jsonl
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# time the model, not LLM cache hits (requests run one at a time, so
+# singleflight never coalesces them); set before the cache module reads it
+os.environ["LLM_CACHE_ENABLED"] = "false"
+
+from agent_core import run_email_agent  # noqa: E402
+
+# placeholder user; signature lookups fall back to the default name
+DEFAULT_USER_ID = "000000000000000000000000"
+
+
+def load_fixtures(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_input_text(fixture: dict) -> str:
+    user_id = fixture.get("user_id", DEFAULT_USER_ID)
+    return (
+        f"Subject: {fixture['subject']}\nFrom: {fixture['sender']}\n\n"
+        f"Body: {fixture.get('snippet', '')} user_id:{user_id}"
+    )
+
+
+def decision_of(output) -> str:
+    if not isinstance(output, str):
+        return "error"
+    output = output.lower().strip()
+    for decision in ("junk", "easy", "hard"):
+        if output.startswith(decision):
+            return decision
+    return "hard"
+
+
+async def run_once(input_text: str, mode: str):
+    start = time.perf_counter()
+    output = await run_email_agent(input_text, mode=mode)
+    return decision_of(output), time.perf_counter() - start
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def main(path: str, repeat: int):
+    fixtures = load_fixtures(path)
+    latencies = {"agents": [], "fast": []}
+    correct = {"agents": 0, "fast": 0}
+    labelled = 0
+    agree = 0
+    total = 0
+
+    for fixture in fixtures:
+        input_text = to_input_text(fixture)
+        for _ in range(repeat):
+            decisions = {}
+            for mode in ("agents", "fast"):
+                decisions[mode], elapsed = await run_once(input_text, mode)
+                latencies[mode].append(elapsed)
+
+            total += 1
+            agree += decisions["agents"] == decisions["fast"]
+            if fixture.get("expected"):
+                labelled += 1
+                for mode in decisions:
+                    correct[mode] += decisions[mode] == fixture["expected"]
+
+            print(
+                f"{fixture['subject'][:40]:40}  agents={decisions['agents']:5}  "
+                f"fast={decisions['fast']:5}  expected={fixture.get('expected', '-')}"
+            )
+
+    print()
+    for mode, values in latencies.items():
+        line = (
+            f"{mode:6}  p50={statistics.median(values):.2f}s  "
+            f"p95={percentile(values, 0.95):.2f}s  mean={statistics.mean(values):.2f}s"
+        )
+        if labelled:
+            line += f"  accuracy={correct[mode] / labelled:.0%}"
+        print(line)
+    print(f"decision agreement: {agree}/{total} ({agree / total:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark email triage modes")
+    parser.add_argument("fixtures", help="JSONL with subject, sender, snippet[, expected]")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args.fixtures, args.repeat))
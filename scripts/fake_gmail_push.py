@@ -0,0 +1,48 @@
+# Local stand-in for Google Pub/Sub: posts a fake Gmail watch notification
+# to the push webhook, e.g.
+#   python scripts/fake_gmail_push.py someone@gmail.com --history-id 12345
+
+import argparse
+import base64
+import json
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+
+
+def build_push_payload(email_address: str, history_id: int) -> dict:
+    data = json.dumps({"emailAddress": email_address, "historyId": history_id})
+    return {
+        "message": {
+            "data": base64.b64encode(data.encode()).decode(),
+            "messageId": str(uuid.uuid4()),
+            "publishTime": datetime.now(timezone.utc).isoformat(),
+        },
+        "subscription": "projects/local/subscriptions/gmail-push",
+    }
+
+
+def send_fake_notification(url: str, email_address: str, history_id: int):
+    body = json.dumps(build_push_payload(email_address, history_id)).encode()
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.status, json.loads(response.read() or b"{}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post a fake Gmail push notification")
+    parser.add_argument("email_address")
+    parser.add_argument("--history-id", type=int, default=1)
+    parser.add_argument("--url", default="http://localhost:8000/api/v1/gmail/push")
+    parser.add_argument("--token", default=None, help="value of GMAIL_PUSH_TOKEN")
+    parser.add_argument("--count", type=int, default=1, help="notifications to send")
+    args = parser.parse_args()
+
+    url = f"{args.url}?token={args.token}" if args.token else args.url
+    for i in range(args.count):
+        status, result = send_fake_notification(
+            url, args.email_address, args.history_id + i
+        )
+        print(status, result)
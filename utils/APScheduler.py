@@ -1,17 +1,85 @@
-from utils.scheduler import scheduler
-from gmail_service import fetch_recent_emails, get_gmail_service
-from utils.email_processor import process_email
-from models.users import users
+from gmail_service import (
+    fetch_recent_emails,
+    get_gmail_service,
+    get_gmail_watch_expiration,
+    start_gmail_watch,
+    PendingLabelChanges,
+    flush_label_changes_async,
+)
+from utils.email_processor import process_email, triage_batch
+from agent_core import EMAIL_TRIAGE_MODE
+from utils.sync_dispatcher import SyncDispatcher
+from models.users import get_user_profile, invalidate_user_profile
+from utils.qouta import quota_leases
 import asyncio
+import os
 from models.jobs import jobs
 from datetime import datetime, timedelta
+from dotenv import load_dotenv
 
+load_dotenv()
 
+# Push mode: Gmail notifies /api/v1/gmail/push and the interval job is only
+# a slow safety-net poll
+GMAIL_PUSH_ENABLED = os.getenv("GMAIL_PUSH_ENABLED", "false").lower() == "true"
+SAFETY_NET_POLL_MINUTES = int(os.getenv("GMAIL_SAFETY_NET_POLL_MINUTES", "30"))
+# Gmail watches expire after 7 days, renew well before that
+WATCH_RENEW_BEFORE = timedelta(days=1)
+# How many emails of one sync batch are processed at the same time
+EMAIL_PROCESS_CONCURRENCY = int(os.getenv("EMAIL_PROCESS_CONCURRENCY", "3"))
+
+# Central sync worker pool (replaces one APScheduler job per user)
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "8"))
+SYNC_JITTER = float(os.getenv("SYNC_JITTER", "0.1"))
+SYNC_PRO_WEIGHT = int(os.getenv("SYNC_PRO_WEIGHT", "3"))
 
 # Store job metadata to control auto-stop timers
 ACTIVE_JOBS = {}
 
 
+# ✅ Helper: process one sync batch concurrently
+async def _process_batch(emails, user_id, service, label_changes) -> bool:
+    """
+    Process emails concurrently, up to EMAIL_PROCESS_CONCURRENCY at a time.
+
+    Emails of the same Gmail thread are handled one after another, oldest
+    first, so replies within a thread keep their order. Once an email comes
+    back quota_exceeded no further emails are dispatched.
+
+    Returns True if the quota ran out.
+    """
+    semaphore = asyncio.Semaphore(EMAIL_PROCESS_CONCURRENCY)
+    quota_exceeded = asyncio.Event()
+
+    # one structured call for the whole run, per-email triage for anything
+    # the batch didn't decide
+    decisions = {}
+    if EMAIL_TRIAGE_MODE == "batch":
+        decisions = await triage_batch(emails, user_id)
+
+    threads = {}
+    for email in emails:
+        threads.setdefault(email.get("threadId") or email["id"], []).append(email)
+
+    async def process_thread(thread_emails):
+        for email in sorted(thread_emails, key=lambda e: e.get("historyId", 0)):
+            async with semaphore:
+                if quota_exceeded.is_set():
+                    return
+                result = await process_email(
+                    email,
+                    user_id,
+                    label_changes,
+                    service=service,
+                    triage=decisions.get(email["id"]),
+                )
+            if result.get("status", "").startswith("quota_exceeded"):
+                quota_exceeded.set()
+
+    await asyncio.gather(*(process_thread(t) for t in threads.values()))
+    return quota_exceeded.is_set()
+
+
 # ✅ Helper: actual email processing
 async def _process_emails(user_id: str):
     try:
@@ -23,50 +91,83 @@ async def _process_emails(user_id: str):
             print(f"No new emails yet for {user_id}")
             return
 
-        for email in emails:
-            await process_email(email, user_id)
-            if email.get("status").startswith("quota_exceeded"):
+        # trash / mark-as-read are sent as batchModify calls once per run
+        label_changes = PendingLabelChanges()
+        try:
+            if await _process_batch(emails, user_id, service, label_changes):
                 stop_user_scheduler(user_id)
                 await jobs.update_one(
                     {"user_id": user_id}, {"$set": {"is_sync_running": False}}
                 )
                 print(f"🛑 Stopped scheduler for {user_id} (qouta exceeded)")
                 return {f"🛑 Stopped scheduler for {user_id} (qouta exceeded)"}
+        finally:
+            await flush_label_changes_async(service, user_id, label_changes)
 
     except Exception as e:
         print(f"❌ Error in job for {user_id}: {e}")
 
 
 
-# ✅ Wrapper: this is the job scheduler will call
-async def scheduled_email_check(user_id: str):
-    asyncio.create_task(_process_emails(user_id))
+# ✅ One mailbox sync, run by the dispatcher's workers
+async def _sync_mailbox(user_id: str):
+    await _process_emails(user_id)
+    if GMAIL_PUSH_ENABLED:
+        await _renew_watch_if_needed(user_id)
+
+
+sync_dispatcher = SyncDispatcher(
+    _sync_mailbox,
+    workers=SYNC_WORKERS,
+    jitter=SYNC_JITTER,
+    pro_weight=SYNC_PRO_WEIGHT,
+)
+
+
+async def _renew_watch_if_needed(user_id: str):
+    try:
+        expiration = await get_gmail_watch_expiration(user_id)
+        if expiration and expiration - datetime.utcnow() > WATCH_RENEW_BEFORE:
+            return
+        service = await get_gmail_service(user_id)
+        await start_gmail_watch(service, user_id)
+        print(f"🔔 Gmail watch registered for {user_id}")
+    except Exception as e:
+        print(f"⚠️ Could not register Gmail watch for {user_id}: {e}")
+
+
+# ✅ Push notification: sync just this mailbox now
+def trigger_user_sync(user_id: str) -> bool:
+    """Queue an immediate sync for a user with an active email job."""
+    return sync_dispatcher.trigger(user_id)
 
 
 
 # ✅ Start job for a user
 async def start_user_scheduler(user_id: str, interval_minutes: int):
-    user = await users.find_one({"_id": user_id})
-    if not user:
+    # jobs are (re)started right after the user connects Gmail or changes
+    # plan, so don't trust the cached profile or quota lease here
+    invalidate_user_profile(user_id)
+    quota_leases.release(user_id)
+    profile = await get_user_profile(user_id)
+    if not profile:
         print(f"⚠️ User not found for scheduler: {user_id}")
         return
 
-    is_pro = user.get("isProUser")
-    job_id = f"user_{user_id}"
+    is_pro = profile.is_pro
 
     # Avoid duplicate jobs
-    if scheduler.get_job(job_id):
+    if sync_dispatcher.is_registered(user_id):
         print(f"⚠️ Job already running for user {user_id}")
         return
 
-    scheduler.add_job(
-        scheduled_email_check,
-        "interval",
-        minutes=interval_minutes,
-        args=[user_id],
-        id=job_id,
-        max_instances=1,
-    )
+    if GMAIL_PUSH_ENABLED:
+        # new mail arrives through the webhook, polling is only a fallback
+        interval_minutes = max(interval_minutes, SAFETY_NET_POLL_MINUTES)
+        await _renew_watch_if_needed(user_id)
+
+    sync_dispatcher.start()
+    sync_dispatcher.register(user_id, interval_minutes * 60, is_pro=is_pro)
     print(f"✅ Started scheduler for {user_id} every {interval_minutes} minutes")
 
     # Save job metadata
@@ -79,10 +180,7 @@ async def start_user_scheduler(user_id: str, interval_minutes: int):
 
 # ✅ Stop job for a user
 def stop_user_scheduler(user_id: str):
-    job_id = f"user_{user_id}"
-    job = scheduler.get_job(job_id)
-    if job:
-        scheduler.remove_job(job_id)
+    if sync_dispatcher.unregister(user_id):
         print(f"🛑 Stopped scheduler for {user_id}")
     else:
         print(f"⚠️ No active job found for {user_id}")
@@ -1,7 +1,171 @@
 from models.analytics_overview import analytics_overview
 from datetime import datetime
+from collections import defaultdict
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+import asyncio
+import os
+
+load_dotenv()
+
+# Write-behind buffering of analytics counters: increments are coalesced per
+# user and field in memory and flushed with one bulk_write
+ANALYTICS_WRITE_BEHIND = os.getenv("ANALYTICS_WRITE_BEHIND", "true").lower() == "true"
+ANALYTICS_FLUSH_INTERVAL_MS = int(os.getenv("ANALYTICS_FLUSH_INTERVAL_MS", "2000"))
+ANALYTICS_FLUSH_MAX_EVENTS = int(os.getenv("ANALYTICS_FLUSH_MAX_EVENTS", "500"))
+ANALYTICS_MAX_PENDING_USERS = int(os.getenv("ANALYTICS_MAX_PENDING_USERS", "5000"))
+
+
+class AnalyticsWriteBuffer:
+    """
+    Coalesces `$inc` deltas per user/field and daily email volume counts,
+    flushing them every `flush_interval_ms` or after `max_events` increments.
+
+    Memory is bounded by `max_pending_users`: reaching it forces a flush, and
+    deltas from a failed flush are only kept while under that bound. A user
+    with both counters and volume pending counts twice, which keeps the
+    check O(1) on every increment.
+
+    Once stopped it refuses new increments; callers write directly instead.
+    """
+
+    def __init__(self, collection, flush_interval_ms: int, max_events: int, max_pending_users: int):
+        self.collection = collection
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_events = max_events
+        self.max_pending_users = max_pending_users
+
+        self._counters = defaultdict(lambda: defaultdict(int))  # user -> path -> delta
+        self._volume = defaultdict(lambda: defaultdict(int))  # user -> date -> count
+        self._events = 0
+        self._flush_now = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.stopped = False
+
+    def _pending_users(self) -> int:
+        return len(self._counters) + len(self._volume)
+
+    def _added(self):
+        if self.stopped:
+            raise RuntimeError("Analytics write buffer is stopped")
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        self._events += 1
+        if (
+            self._events >= self.max_events
+            or self._pending_users() >= self.max_pending_users
+        ):
+            self._flush_now.set()
+
+    def inc(self, user_id: str, path: str, value: int = 1):
+        self._counters[user_id][path] += value
+        self._added()
+
+    def inc_volume(self, user_id: str, date: str, count: int = 1):
+        self._volume[user_id][date] += count
+        self._added()
+
+    def _build_ops(self, counters, volume):
+        """
+        Returns (ops, owners): owners[i] is the delta ops[i] applies, as
+        ("counters", user_id) or ("volume", user_id, date), or None for the
+        idempotent "add today's entry" pushes.
+        """
+        now = datetime.utcnow()
+        ops, owners = [], []
+        for user_id in counters.keys() | volume.keys():
+            update = {"$set": {"lastUpdated": now}}
+            if counters.get(user_id):
+                update["$inc"] = dict(counters[user_id])
+            ops.append(UpdateOne({"userId": user_id}, update, upsert=True))
+            owners.append(("counters", user_id) if counters.get(user_id) else None)
+
+            for date, count in volume.get(user_id, {}).items():
+                # add today's entry if missing, then bump it positionally
+                ops.append(
+                    UpdateOne(
+                        {"userId": user_id, "charts.emailVolume.date": {"$ne": date}},
+                        {"$push": {"charts.emailVolume": {"date": date, "count": 0}}},
+                    )
+                )
+                owners.append(None)
+                ops.append(
+                    UpdateOne(
+                        {"userId": user_id, "charts.emailVolume.date": date},
+                        {"$inc": {"charts.emailVolume.$.count": count}},
+                    )
+                )
+                owners.append(("volume", user_id, date))
+        return ops, owners
+
+    async def flush(self):
+        async with self._flush_lock:
+            counters, self._counters = self._counters, defaultdict(lambda: defaultdict(int))
+            volume, self._volume = self._volume, defaultdict(lambda: defaultdict(int))
+            self._events = 0
+            self._flush_now.clear()
+
+            ops, owners = self._build_ops(counters, volume)
+            if not ops:
+                return
+            try:
+                await self.collection.bulk_write(ops, ordered=True)
+            except BulkWriteError as e:
+                # ordered: everything before the first failing op was applied
+                failed_at = e.details["writeErrors"][0]["index"]
+                print(f"❌ Analytics flush failed at op {failed_at}/{len(ops)}: {e}")
+                self._restore(counters, volume, owners[failed_at:])
+            except Exception as e:
+                # nothing was acknowledged, assume nothing was applied
+                print(f"❌ Analytics flush failed: {e}")
+                self._restore(counters, volume, owners)
+
+    def _restore(self, counters, volume, owners):
+        owners = [owner for owner in owners if owner is not None]
+        users = {owner[:2] for owner in owners}  # same unit as _pending_users
+        if self._pending_users() + len(users) > self.max_pending_users:
+            print("⚠️ Dropping analytics deltas, write-behind buffer is full")
+            return
+        for owner in owners:
+            if owner[0] == "counters":
+                for path, value in counters[owner[1]].items():
+                    self._counters[owner[1]][path] += value
+            else:
+                _, user_id, date = owner
+                self._volume[user_id][date] += volume[user_id][date]
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def stop(self):
+        self.stopped = True
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+analytics_buffer = AnalyticsWriteBuffer(
+    analytics_overview,
+    ANALYTICS_FLUSH_INTERVAL_MS,
+    ANALYTICS_FLUSH_MAX_EVENTS,
+    ANALYTICS_MAX_PENDING_USERS,
+)
+
 
 async def update_analytics(user_id: str, field: str, value: int = 1):
+    if ANALYTICS_WRITE_BEHIND and not analytics_buffer.stopped:
+        analytics_buffer.inc(user_id, f"overview.{field}", value)
+        return
+
     await analytics_overview.update_one(
         {"userId": user_id},
         {
@@ -10,8 +174,12 @@ async def update_analytics(user_id: str, field: str, value: int = 1):
         },
         upsert=True
     )
-    
+
 async def update_sequence_progress(user_id: str, field: str, value: int = 1):
+    if ANALYTICS_WRITE_BEHIND and not analytics_buffer.stopped:
+        analytics_buffer.inc(user_id, f"charts.sequenceProgress.{field}", value)
+        return
+
     await analytics_overview.update_one(
         {"userId": user_id},
         {
@@ -26,6 +194,10 @@ async def update_sequence_progress(user_id: str, field: str, value: int = 1):
 async def update_email_volume(user_id: str, count: int = 1):
     today = datetime.utcnow().strftime("%Y-%m-%d")
 
+    if ANALYTICS_WRITE_BEHIND and not analytics_buffer.stopped:
+        analytics_buffer.inc_volume(user_id, today, count)
+        return
+
     result = await analytics_overview.update_one(
         {"userId": user_id, "charts.emailVolume.date": today},
         {
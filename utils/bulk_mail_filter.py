@@ -0,0 +1,110 @@
+import os
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from utils.regex_junk_detection import parse_sender
+
+# Newsletters and automated mail are recognised from headers and Gmail
+# category labels alone, before any quota is consumed or LLM is called.
+BULK_MAIL_FILTER = os.getenv("BULK_MAIL_FILTER", "true").lower() == "true"
+# Signals that trash the email; any other signal only skips it (left unread
+# in the inbox, no reply). Matched on the signal name or its kind, e.g.
+# "precedence" or "precedence:junk". Gmail category labels only skip by
+# default, they also land on receipts and mail the user asked for.
+BULK_MAIL_JUNK_SIGNALS = {
+    s.strip()
+    for s in os.getenv("BULK_MAIL_JUNK_SIGNALS", "precedence:junk").split(",")
+    if s.strip()
+}
+
+# Headers fetched with Subject/From in the same metadata request
+BULK_HEADERS = [
+    "List-Unsubscribe",
+    "List-Id",
+    "Precedence",
+    "Auto-Submitted",
+    "X-Mailer",
+]
+
+BULK_LABELS = ["CATEGORY_PROMOTIONS", "CATEGORY_UPDATES", "CATEGORY_FORUMS", "CATEGORY_SOCIAL"]
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+BULK_MAILERS = re.compile(
+    r"mailchimp|sendgrid|mailgun|sendinblue|brevo|hubspot|marketo|klaviyo"
+    r"|constant ?contact|campaign ?monitor|mailerlite|customer\.io|salesforce marketing",
+    re.IGNORECASE,
+)
+# what _signals() emits, before any ":<value>"
+SIGNAL_KINDS = {
+    "label",
+    "list_unsubscribe",
+    "list_id",
+    "precedence",
+    "auto_submitted",
+    "x_mailer",
+    "noreply_sender",
+}
+NOREPLY_RE = re.compile(r"^(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|notifications?)[+@]")
+
+
+@dataclass(frozen=True)
+class BulkVerdict:
+    action: str | None  # "junk" | "skip" | None (not bulk)
+    reasons: tuple[str, ...] = ()
+
+
+_counts = defaultdict(int)
+
+
+def _signals(email: dict) -> list[str]:
+    headers = {k.lower(): v for k, v in (email.get("headers") or {}).items()}
+    signals = []
+    for label in email.get("labelIds") or ():
+        if label in BULK_LABELS:
+            signals.append(f"label:{label}")
+    if headers.get("list-unsubscribe"):
+        signals.append("list_unsubscribe")
+    if headers.get("list-id"):
+        signals.append("list_id")
+    precedence = (headers.get("precedence") or "").strip().lower()
+    if precedence in BULK_PRECEDENCE:
+        signals.append(f"precedence:{precedence}")
+    auto_submitted = (headers.get("auto-submitted") or "").strip().lower()
+    if auto_submitted and auto_submitted != "no":
+        signals.append(f"auto_submitted:{auto_submitted.split(';')[0]}")
+    mailer = BULK_MAILERS.search(headers.get("x-mailer") or "")
+    if mailer:
+        signals.append(f"x_mailer:{mailer.group(0).lower()}")
+    address, _ = parse_sender(email.get("sender", ""))
+    if address and NOREPLY_RE.match(address):
+        signals.append("noreply_sender")
+    return signals
+
+
+def classify_bulk(email: dict, record: bool = True) -> BulkVerdict:
+    """
+    Header/label pre-classification of one fetched email. Pre-passes over
+    emails that are classified again later pass record=False, so each
+    email is counted once in bulk_filter_stats().
+    """
+    if not BULK_MAIL_FILTER:
+        return BulkVerdict(None)
+    signals = _signals(email)
+    if not signals:
+        return BulkVerdict(None)
+    junk = any(
+        s in BULK_MAIL_JUNK_SIGNALS or s.split(":", 1)[0] in BULK_MAIL_JUNK_SIGNALS
+        for s in signals
+    )
+    if record:
+        for signal in signals:
+            _counts[signal] += 1
+    return BulkVerdict("junk" if junk else "skip", tuple(signals))
+
+
+def is_bulk_reason(reason: str | None) -> bool:
+    """True for the `reason` saved with emails decided by this filter."""
+    return bool(reason) and reason.split(", ", 1)[0].split(":", 1)[0] in SIGNAL_KINDS
+
+
+def bulk_filter_stats() -> dict:
+    return dict(sorted(_counts.items(), key=lambda item: -item[1]))
@@ -2,41 +2,29 @@ from agents import (
     Agent,
     Runner,
     RunConfig,
-    OpenAIChatCompletionsModel,
     output_guardrail,
     GuardrailFunctionOutput,
     OutputGuardrailTripwireTriggered,
     RunContextWrapper,
     TResponseInputItem,
 )
-from openai import AsyncOpenAI
+from openai.types.responses import ResponseTextDeltaEvent
 from pydantic import BaseModel
-import os
 from dotenv import load_dotenv
-from bson import ObjectId
-from database.mongo import db
+from models.users import get_user_profile, DEFAULT_DISPLAY_NAME
 from urllib.parse import urlparse
+from utils.llm_gateway import get_model
+from utils.llm_cache import content_key
+from utils.singleflight import llm_flight
+from utils.llm_metrics import run_agent, measure_agent
 import re
 
 load_dotenv()
 
-users = db["users"]
-
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-
-provider = AsyncOpenAI(
-    api_key=gemini_api_key,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-)
-
-model = OpenAIChatCompletionsModel(
-    model="gemini-2.0-flash",
-    openai_client=provider,
-)
+model = get_model()
 
 config = RunConfig(
     model=model,
-    model_provider=provider,
     tracing_disabled=True,
 )
 
@@ -77,6 +65,55 @@ def smart_split_variations(output: str) -> list[str]:
     return re.split(r"\n\s*---\s*\n", output.strip())  # [email1, email2]
 
 
+class VariationSplitter:
+    """
+    Incremental smart_split_variations for streamed output: feed() text as it
+    arrives and get back (variation_index, text) pieces. Only a line that may
+    still turn into a `---` delimiter is held back.
+    """
+
+    def __init__(self):
+        self.variations = [""]
+        self._pending = ""
+        self._mid_line = False  # part of the current line was already sent
+
+    def _append(self, text: str, out: list):
+        index = len(self.variations) - 1
+        self.variations[index] += text
+        out.append((index, text))
+
+    def _line(self, line: str, out: list):
+        if not self._mid_line and line.strip() == "---":
+            # a leading delimiter (before any content) doesn't start a new email
+            if self.variations[-1].strip():
+                self.variations.append("")
+        else:
+            self._append(line, out)
+        self._mid_line = False
+
+    def feed(self, text: str) -> list[tuple[int, str]]:
+        out = []
+        self._pending += text
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            self._line(line + "\n", out)
+        if self._pending and (self._mid_line or self._pending.strip() not in ("", "-", "--", "---")):
+            self._append(self._pending, out)
+            self._pending = ""
+            self._mid_line = True
+        return out
+
+    def flush(self) -> list[tuple[int, str]]:
+        out = []
+        if self._pending:
+            self._line(self._pending, out)
+            self._pending = ""
+        return out
+
+    def result(self) -> list[str]:
+        return [v.strip() for v in self.variations if v.strip()]
+
+
 def extract_name_from_linkedin(url: str) -> str:
     if not url.startswith(("http://", "https://")):
         url = "https://" + url
@@ -89,6 +126,33 @@ def extract_name_from_linkedin(url: str) -> str:
     return username.replace("-", " ").title()  # e.g. "John Doe" or "hasnainxdev"
 
 
+async def _generator_prompt(
+    linkedin_url: str,
+    role: str,
+    tone: str,
+    about: str | None,
+    user_id: str,
+    website: str | None = None,
+) -> str:
+    profile = await get_user_profile(user_id)
+    your_name = profile.display_name if profile else DEFAULT_DISPLAY_NAME
+
+    name = extract_name_from_linkedin(linkedin_url)
+    input_prompt = f"""
+Name: {name}
+LinkedIn URL: {linkedin_url}
+Role: {role}
+Website: {website or 'Not provided'}
+Tone: {tone}
+About: {about}
+always end with Best Regard or Best,
+{your_name}
+
+Generate 2 cold email variations.
+"""
+    return input_prompt
+
+
 async def generate_cold_email(
     linkedin_url: str,
     role: str,
@@ -122,33 +186,51 @@ async def generate_cold_email(
             None explicitly, but may raise database-related exceptions
     """
 
-    # here the real logic begins
-    mongo_id = ObjectId(user_id)
-    user = await users.find_one({"_id": mongo_id})
-
-    your_name = user["name"] if user and "name" in user else "PingGenius Assistant"
-
-    # extarct the name remove extra numbers from your_name and add space like "Hasnain siddique"
-    your_name = re.sub(r"\d+", " ", your_name).strip()
-
-    name = extract_name_from_linkedin(linkedin_url)
-    input_prompt = f"""
-Name: {name}
-LinkedIn URL: {linkedin_url}
-Role: {role}
-Website: {website or 'Not provided'}
-Tone: {tone}
-About: {about}
-always end with Best Regard or Best,
-{your_name}
-
-Generate 2 cold email variations.
-"""
+    input_prompt = await _generator_prompt(
+        linkedin_url, role, tone, about, user_id, website
+    )
     try:
-        result = await Runner.run(
-            generator_agent, run_config=config, input=input_prompt
+        # the same profile enriched by several requests at once → one call
+        result = await llm_flight.do(
+            f"cold_email:{content_key(input_prompt)}",
+            run_agent,
+            generator_agent,
+            run_config=config,
+            input=input_prompt,
         )
         print(result.final_output)
         return smart_split_variations(result.final_output)
     except Exception as e:
         print("Error in generate_cold_email:", str(e))
+
+
+async def stream_cold_email(
+    linkedin_url: str,
+    role: str,
+    tone: str,
+    about: str | None,
+    user_id: str,
+    website: str | None = None,
+):
+    """
+    Streaming generate_cold_email. Yields {"type": "delta", "variation", "text"}
+    events as tokens arrive, then {"type": "done", "variations": [...]}.
+    """
+    input_prompt = await _generator_prompt(
+        linkedin_url, role, tone, about, user_id, website
+    )
+    splitter = VariationSplitter()
+
+    with measure_agent(generator_agent.name) as measured:
+        result = Runner.run_streamed(generator_agent, input=input_prompt, run_config=config)
+        async for event in result.stream_events():
+            if event.type == "raw_response_event" and isinstance(
+                event.data, ResponseTextDeltaEvent
+            ):
+                for index, text in splitter.feed(event.data.delta):
+                    yield {"type": "delta", "variation": index + 1, "text": text}
+        measured.usage = result.context_wrapper.usage
+
+    for index, text in splitter.flush():
+        yield {"type": "delta", "variation": index + 1, "text": text}
+    yield {"type": "done", "variations": splitter.result()}
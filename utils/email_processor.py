@@ -1,47 +1,273 @@
 from gmail_service import (
     get_gmail_service,
-    move_to_trash,
-    send_email_reply,
-    marked_as_read,
+    move_to_trash_async,
+    send_email_reply_async,
+    marked_as_read_async,
 )
-from agent_core import run_email_agent
+from agent_core import (
+    run_email_agent,
+    run_batch_triage,
+    write_reply,
+    check_reply,
+    remember_reply,
+    take_reply_check,
+    get_signature_name,
+    SPECULATIVE_GUARDRAILS,
+    SPECULATIVE_MAX_ATTEMPTS,
+)
+from utils.extract_name import extract_name
 from models.emails import save_email
 from models.hard_email import save_hard_email_to_db
 from utils.analytics_service import update_analytics
+from agents import OutputGuardrailTripwireTriggered
 import logging
 import asyncio
 from utils.analytics_service import update_email_volume
-from utils.regex_junk_detection import is_junk_email
-from utils.qouta import try_consume_quota
+from utils.regex_junk_detection import junk_engine
+from utils.bulk_mail_filter import classify_bulk
+from utils.sender_reputation import GUARDRAIL_FAILED_REASON, sender_reputation
+from utils.qouta import remaining_quota, try_consume_quota
+from utils.local_classifier import predict_confident
+from utils.llm_gateway import set_llm_tenant
 
 logger = logging.getLogger(__name__)
 
 
-async def process_email(email, user_id):
+async def _send_with_speculative_guardrail(service, user_id, email, reply):
+    """
+    Send a draft written without the output guardrail once its check passes.
+    The check was started by write_reply as soon as the draft existed (see
+    take_reply_check), so it ran while the main agent finished; drafts that
+    didn't come from there are checked now. A tripped draft is regenerated,
+    up to SPECULATIVE_MAX_ATTEMPTS drafts in total.
+
+    Returns the reply that was sent, or None if every draft tripped.
+    """
+    to_email = email["sender"]
+    signature_name = await get_signature_name(user_id)
+    sender_name = extract_name(to_email)
+
+    for attempt in range(SPECULATIVE_MAX_ATTEMPTS):
+        guardrail = take_reply_check(user_id, reply)
+        passed = await (guardrail or check_reply(reply, signature_name, sender_name))
+        if passed:
+            await send_email_reply_async(
+                service, user_id, to_email, email["subject"], reply
+            )
+            await remember_reply(
+                email["subject"], email.get("snippet", ""), to_email, user_id, reply
+            )
+            return reply
+
+        print(f"⚠️ Reply tripped the guardrail (attempt {attempt + 1})")
+        if attempt < SPECULATIVE_MAX_ATTEMPTS - 1:
+            reply = await write_reply(
+                email["subject"], email.get("snippet", ""), to_email, user_id, guarded=False
+            )
+            # checks are keyed on normalized text, title-casing keeps the match
+            reply = reply.strip().title()
+
+    return None
+
+
+def email_input_text(email, user_id) -> str:
+    return f"Subject: {email['subject']}\nFrom: {email['sender']}\n\nBody: {email.get('snippet','')} user_id:{user_id}"
+
+
+async def triage_batch(emails, user_id) -> dict:
+    """
+    Batch-triage the emails of one sync run that will need the LLM, i.e. not
+    bulk mail, not regex junk, not decided by sender reputation and not
+    confidently classified locally. Returns
+    {email_id: decision} to hand to process_email as `triage`.
+    """
+    set_llm_tenant(user_id)
+    # only as many emails as process_email will get past the quota check;
+    # bulk mail and reputation-routed mail don't consume any
+    emails = [email for email in emails if classify_bulk(email, record=False).action is None]
+    reputations = await asyncio.gather(
+        *(sender_reputation.lookup(email, user_id, record=False) for email in emails)
+    )
+    emails = [
+        email for email, reputation in zip(emails, reputations) if reputation.action is None
+    ]
+    try:
+        remaining = await remaining_quota(user_id, "emailAnalyses")
+    except Exception as e:
+        print(f"⚠️ Could not read the quota, skipping batch triage: {e}")
+        return {}
+    if remaining is not None:
+        emails = emails[:remaining]
+    await junk_engine.refresh()
+    verdicts = junk_engine.score_batch(emails, user_id)
+    candidates = [
+        email
+        for email, verdict in zip(emails, verdicts)
+        if not verdict.is_junk and predict_confident(email) is None
+    ]
+    if len(candidates) < 2:
+        return {}
+    try:
+        return await run_batch_triage(candidates, user_id)
+    except Exception as e:
+        print(f"⚠️ Batch triage failed, falling back to per-email: {e}")
+        return {}
+
+
+async def _handle_bulk(email, user_id, bulk, label_changes, service):
+    """
+    Bulk "junk" is trashed like rule junk; "skip" is left unread in the inbox
+    without a reply. Neither consumes the analyses quota.
+    """
+    reason = ", ".join(bulk.reasons)
+    print(f"📭 Bulk mail ({bulk.action}): {reason}")
+    if bulk.action == "junk":
+        if label_changes is not None:
+            label_changes.move_to_trash(email["id"])
+        else:
+            await move_to_trash_async(service, user_id, email["id"])
+    await save_email(
+        user_id,
+        email["subject"],
+        email["sender"],
+        "",
+        "junk" if bulk.action == "junk" else "skipped",
+        snippet=email.get("snippet", ""),
+        reason=reason,
+    )
+    await update_analytics(user_id, "totalEmails", 1)
+    await update_email_volume(user_id, 1)
+    if bulk.action == "junk":
+        # not recorded in the sender reputation: headers and labels say
+        # nothing about the sender's domain as a whole
+        await update_analytics(user_id, "spamDetected", 1)
+    return {"status": bulk.action, "reason": reason}
+
+
+async def _handle_reputation(email, user_id, reputation, label_changes, service):
+    """
+    Route an email from its sender's history. Not recorded back into the
+    reputation, so the counts can decay if the sender changes, and like bulk
+    mail it doesn't consume the analyses quota.
+    """
+    print(f"📇 Sender reputation: {reputation.reason}")
+    await update_analytics(user_id, "totalEmails", 1)
+    await update_email_volume(user_id, 1)
+    if reputation.action == "junk":
+        if label_changes is not None:
+            label_changes.move_to_trash(email["id"])
+        else:
+            await move_to_trash_async(service, user_id, email["id"])
+        await save_email(
+            user_id,
+            email["subject"],
+            email["sender"],
+            "",
+            "junk",
+            snippet=email.get("snippet", ""),
+            reason=reputation.reason,
+        )
+        await update_analytics(user_id, "spamDetected", 1)
+        return {"status": "junk", "reason": reputation.reason}
+
+    await save_hard_email_to_db(email, user_id, reason=reputation.reason)
+    await update_analytics(user_id, "hardEmails", 1)
+    return {"status": "hard", "reason": reputation.reason}
+
+
+async def process_email(email, user_id, label_changes=None, service=None, triage=None):
+    """
+    Triage and handle a single fetched email.
+
+    Pass the Gmail `service` the caller already built to avoid resolving it
+    again for every email.
+
+    `triage` is a decision precomputed by triage_batch(); it replaces the
+    per-email LLM triage.
+
+    When `label_changes` (a PendingLabelChanges) is given, trash and
+    mark-as-read operations are queued on it instead of being sent right
+    away; the caller flushes them once per sync run.
+    """
     try:
         if not email or "id" not in email:
             raise ValueError("Invalid email payload")
 
-        service = await get_gmail_service(user_id)
-        input_text = f"Subject: {email['subject']}\nFrom: {email['sender']}\n\nBody: {email.get('snippet','')} user_id:{user_id}"
+        # LLM calls below count against this user's concurrency share
+        set_llm_tenant(user_id)
+
+        if service is None:
+            service = await get_gmail_service(user_id)
+        input_text = email_input_text(email, user_id)
+
+        # ✅ Newsletters / automated mail, from headers and labels alone
+        bulk = classify_bulk(email)
+        if bulk.action is not None:
+            return await _handle_bulk(email, user_id, bulk, label_changes, service)
+
+        # ✅ Sender reputation: a one-sided junk/hard history skips the LLM
+        reputation = await sender_reputation.lookup(email, user_id)
+        if reputation.action is not None:
+            return await _handle_reputation(email, user_id, reputation, label_changes, service)
 
         consumed = await try_consume_quota(user_id, "emailAnalyses", 1)
         if not consumed:
             # quota exhausted: store email, mark throttled, notify the user via UI later
             return {"status": "quota_exceeded for email analyses"}
 
-        # ✅ Junk detection (regex)
-        if is_junk_email(input_text):
-            move_to_trash(service, email["id"])
-            await save_email(user_id, email["subject"], email["sender"], "", "junk")
+        # ✅ Junk detection (compiled rules + this user's allow/deny lists)
+        await junk_engine.refresh()
+        junk = junk_engine.score(email, user_id)
+        if junk.is_junk:
+            print(f"🗑️ Junk rules hit: {', '.join(junk.hits)}")
+            if label_changes is not None:
+                label_changes.move_to_trash(email["id"])
+            else:
+                await move_to_trash_async(service, user_id, email["id"])
+            await save_email(
+                user_id,
+                email["subject"],
+                email["sender"],
+                "",
+                "junk",
+                snippet=email.get("snippet", ""),
+                reason=", ".join(junk.hits),
+            )
             await update_analytics(user_id, "totalEmails", 1)
             await update_email_volume(user_id, 1)
             await update_analytics(user_id, "spamDetected", 1)
+            await sender_reputation.record(user_id, email["sender"], "junk")
 
             print("Email marked as junk and moved to trash and stored ✅")
             return {"status": "junk"}
 
-        result = await run_email_agent(input_text)
+        # ✅ Local classifier: skip the LLM triage when it is confident
+        hard_reason = None
+        local_decision = predict_confident(email)
+        if local_decision == "easy":
+            # still needs the LLM for the reply, but not for classification
+            try:
+                reply = await write_reply(
+                    email["subject"],
+                    email.get("snippet", ""),
+                    email["sender"],
+                    user_id,
+                    guarded=not SPECULATIVE_GUARDRAILS,
+                )
+                result = f"easy: {reply}"
+            except OutputGuardrailTripwireTriggered:
+                # already charged and marked processed: keep it for review
+                print("⚠️ Reply failed the guardrail, leaving it for review")
+                result, hard_reason = "hard", GUARDRAIL_FAILED_REASON
+        elif local_decision in ("junk", "hard"):
+            result = local_decision
+        elif triage is not None:
+            result = triage
+        else:
+            result = await run_email_agent(
+                input_text, junk_checked=True, email=email, user_id=user_id
+            )
+
         if not isinstance(result, str):
             print("⚠️ Agent returned:", repr(result))
             raise RuntimeError("Agent returned non-string")
@@ -54,29 +280,59 @@ async def process_email(email, user_id):
 
         # fallback if agent junk detection triggers
         if decision.startswith("junk"):
+            await sender_reputation.record(user_id, email["sender"], "junk")
             return {"status": "junk"}
 
         if decision.startswith("easy:"):
             reply = decision.split("easy:", 1)[1].strip().title()
             # sending raw email
             to_email = email["sender"]
-            send_email_reply(service, to_email, email["subject"], reply)
-            marked_as_read(service, email["id"])
-            await save_email(user_id, email["subject"], to_email, reply, "easy")
+            if SPECULATIVE_GUARDRAILS:
+                reply = await _send_with_speculative_guardrail(
+                    service, user_id, email, reply
+                )
+                if reply is None:
+                    # no draft passed the guardrail, leave it for manual review
+                    await save_hard_email_to_db(
+                        email, user_id, reason=GUARDRAIL_FAILED_REASON
+                    )
+                    # not recorded: the email was easy, only our draft failed
+                    await update_analytics(user_id, "hardEmails", 1)
+                    print("Reply kept failing the guardrail, stored as hard ✅")
+                    return {"status": "hard"}
+            else:
+                await send_email_reply_async(
+                    service, user_id, to_email, email["subject"], reply
+                )
+            if label_changes is not None:
+                label_changes.marked_as_read(email["id"])
+            else:
+                await marked_as_read_async(service, user_id, email["id"])
+            await save_email(
+                user_id,
+                email["subject"],
+                to_email,
+                reply,
+                "easy",
+                snippet=email.get("snippet", ""),
+            )
 
             # Consume auto-reply quota
             await try_consume_quota(user_id, "autoReplies", 1)
 
             # ✅ Update analytics
             await update_analytics(user_id, "autoReplied", 1)
+            await sender_reputation.record(user_id, to_email, "easy")
 
             print("Easy email replied and marked as read and stored ✅")
             return {"status": "easy", "reply": reply.title()}
 
-        await save_hard_email_to_db(email, user_id)
+        await save_hard_email_to_db(email, user_id, reason=hard_reason)
 
         # ✅ Update analytics
         await update_analytics(user_id, "hardEmails", 1)
+        if hard_reason is None:
+            await sender_reputation.record(user_id, email["sender"], "hard")
 
         print("Email marked as hard and stored for manual review ✅")
         return {"status": "hard"}
@@ -1,5 +1,5 @@
 import re
-from agents import Runner
+from utils.llm_metrics import run_agent
 from utils.followups_agent import followups_generator_agent
 
 
@@ -60,5 +60,5 @@ Email 1
 Email 2
 """
 
-    result = await Runner.run(followups_generator_agent, input=input_prompt)
+    result = await run_agent(followups_generator_agent, input=input_prompt)
     return smart_split_variations(result.final_output)
@@ -1,33 +1,22 @@
 from agents import (
     Agent,
     RunContextWrapper,
-    Runner,
     set_tracing_disabled,
-    OpenAIChatCompletionsModel,
     GuardrailFunctionOutput,
     output_guardrail,
     TResponseInputItem,
 )
 from pydantic import BaseModel
+from utils.reply_validators import validate_followups, record_llm_verdict, ESCALATE, REJECT
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-import os
+from utils.llm_gateway import get_model
+from utils.llm_metrics import run_agent
 
 load_dotenv()
 set_tracing_disabled(disabled=True)
 
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-
-
-provider = AsyncOpenAI(
-    api_key=gemini_api_key,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-)
-
-model = OpenAIChatCompletionsModel(
-    model="gemini-2.0-flash",
-    openai_client=provider,
-)
+model = get_model()
+fast_model = get_model("fast")
 
 
 class FollowUpEmailOutput(BaseModel):
@@ -48,7 +37,7 @@ If YES → return: is_follow_up_email = True
 If NO → return: is_follow_up_email = False
 
 """,
-    model=model,
+    model=fast_model,
     output_type=FollowUpEmailOutput,
 )
 
@@ -57,11 +46,20 @@ If NO → return: is_follow_up_email = False
 async def validate_cold_email_output(
     ctx: RunContextWrapper, agent: Agent, input: str | list[TResponseInputItem]
 ) -> GuardrailFunctionOutput:
-    result = await Runner.run(
+    check = validate_followups(input, guardrail="followups_email_guardrail")
+    if check.verdict != ESCALATE:
+        return GuardrailFunctionOutput(
+            output_info=check, tripwire_triggered=check.verdict == REJECT
+        )
+
+    result = await run_agent(
         followups_email_guardrail,
         input=input,
         context=ctx.context,
     )
+    record_llm_verdict(
+        "followups_email_guardrail", result.final_output.is_follow_up_email
+    )
     return GuardrailFunctionOutput(
         output_info=result.final_output,
         tripwire_triggered=not result.final_output.is_follow_up_email,
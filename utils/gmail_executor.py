@@ -0,0 +1,86 @@
+import asyncio
+import os
+import random
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from googleapiclient.errors import HttpError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Dedicated pool so blocking google-api-python-client calls never run on the
+# event loop (and don't compete with the default executor)
+GMAIL_THREAD_POOL_SIZE = int(os.getenv("GMAIL_THREAD_POOL_SIZE", "16"))
+GMAIL_MAX_CONCURRENCY = int(os.getenv("GMAIL_MAX_CONCURRENCY", "16"))
+# A built Gmail service shares one httplib2 connection, which is not
+# thread-safe, so calls for the same user are serialized by default
+GMAIL_MAX_CONCURRENCY_PER_USER = int(os.getenv("GMAIL_MAX_CONCURRENCY_PER_USER", "1"))
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "4"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+_executor = ThreadPoolExecutor(
+    max_workers=GMAIL_THREAD_POOL_SIZE, thread_name_prefix="gmail"
+)
+_global_limit = asyncio.Semaphore(GMAIL_MAX_CONCURRENCY)
+# entries disappear once no call for that user holds the semaphore
+_user_limits = weakref.WeakValueDictionary()
+
+
+def _user_limit(user_id: str) -> asyncio.Semaphore:
+    key = str(user_id)
+    limit = _user_limits.get(key)
+    if limit is None:
+        limit = asyncio.Semaphore(GMAIL_MAX_CONCURRENCY_PER_USER)
+        _user_limits[key] = limit
+    return limit
+
+
+def retry_delay(error: HttpError | None, attempt: int) -> float:
+    retry_after = error.resp.get("retry-after") if error is not None and error.resp else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # exponential backoff with full jitter, capped at 30s
+    return random.uniform(0, min(30.0, 0.5 * 2**attempt))
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUS
+
+
+async def run_gmail_call_once(user_id: str, fn, *args, **kwargs):
+    """run_gmail_call without retries, for callers that retry on their own."""
+    loop = asyncio.get_running_loop()
+    async with _global_limit, _user_limit(user_id):
+        return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+async def run_gmail_call(user_id: str, fn, *args, **kwargs):
+    """
+    Run a blocking Gmail call (e.g. `request.execute`) in the Gmail thread
+    pool, bounded by the global and per-user concurrency limits.
+
+    429 and 5xx responses are retried up to GMAIL_MAX_RETRIES times, honouring
+    the Retry-After header when Google sends one.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await run_gmail_call_once(user_id, fn, *args, **kwargs)
+        except HttpError as e:
+            if not is_retryable(e) or attempt >= GMAIL_MAX_RETRIES:
+                raise
+            delay = retry_delay(e, attempt)
+
+        # back off without holding a concurrency slot
+        attempt += 1
+        print(f"⏳ Gmail call throttled for {user_id}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+def shutdown_gmail_executor():
+    _executor.shutdown(wait=False, cancel_futures=True)
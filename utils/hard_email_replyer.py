@@ -2,7 +2,6 @@ import asyncio
 from agents import (
     Agent,
     Runner,
-    OpenAIChatCompletionsModel,
     set_tracing_disabled,
     GuardrailFunctionOutput,
     output_guardrail,
@@ -11,8 +10,11 @@ from agents import (
     TResponseInputItem,
     enable_verbose_stdout_logging,
 )
-from openai import AsyncOpenAI
+from utils.llm_gateway import get_model
+from utils.llm_metrics import run_agent, measure_agent
+from openai.types.responses import ResponseTextDeltaEvent
 from pydantic import BaseModel
+from utils.reply_validators import validate_reply, record_llm_verdict, ESCALATE, REJECT
 import os
 from dotenv import load_dotenv
 import re
@@ -20,18 +22,13 @@ from pydantic import BaseModel
 
 load_dotenv()
 set_tracing_disabled(disabled=True)
-# enable_verbose_stdout_logging()
-gemini_api_key = os.getenv("GEMINI_API_KEY")
-
-provider = AsyncOpenAI(
-    api_key=gemini_api_key,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-)
 
-model = OpenAIChatCompletionsModel(
-    model="gemini-2.0-flash",
-    openai_client=provider,
-)
+# enable_verbose_stdout_logging()
+# refinements longer than this (estimated prompt tokens) are written by the
+# strong model tier
+HARD_REPLY_STRONG_ABOVE_TOKENS = int(os.getenv("HARD_REPLY_STRONG_ABOVE_TOKENS", "800"))
+model = get_model(escalate_above=HARD_REPLY_STRONG_ABOVE_TOKENS)
+fast_model = get_model("fast")
 
 
 class EmailReplyOutputCheck(BaseModel):
@@ -57,7 +54,7 @@ Set is_valid_reply = false if:
 
 If all the above requirements meets, return: is_valid_reply -> true
 """,
-    model=model,
+    model=fast_model,
     output_type=EmailReplyOutputCheck,
 )
 
@@ -68,7 +65,20 @@ async def email_reply_validation_guardrail(
     agent: Agent,
     input: str | list[TResponseInputItem],
 ) -> GuardrailFunctionOutput:
-    result = await Runner.run(email_reply_validate, input, context=ctx.context)
+    names = ctx.context if isinstance(ctx.context, dict) else {}
+    check = validate_reply(
+        input,
+        signature_name=names.get("signature_name"),
+        sender_name=names.get("sender_name"),
+        guardrail="email_reply_validate",
+    )
+    if check.verdict != ESCALATE:
+        return GuardrailFunctionOutput(
+            output_info=check, tripwire_triggered=check.verdict == REJECT
+        )
+
+    result = await run_agent(email_reply_validate, input, context=ctx.context)
+    record_llm_verdict("email_reply_validate", result.final_output.is_valid_reply)
     return GuardrailFunctionOutput(
         output_info=result.final_output,
         tripwire_triggered=not result.final_output.is_valid_reply,
@@ -93,12 +103,12 @@ Your job is to:
     output_guardrails=[email_reply_validation_guardrail],
 )
 
+# same writer without the guardrail, for speculative checking by the caller
+draft_reply_agent = reply_agent.clone(output_guardrails=[])
 
-async def generate_reply(refined_body: str, your_name: str, sender_name: str) -> str:
-    try:
-        result = await Runner.run(
-            reply_agent,
-            input=f"""
+
+def _reply_prompt(refined_body: str, your_name: str, sender_name: str) -> str:
+    return f"""
 You are the professional email reply writer.
 
 The user has refined their draft.  
@@ -106,10 +116,66 @@ Draft the reply with:
 - A greeting using the sender’s name: {sender_name}
 - The refined content: {refined_body}
 - A closing signed off with the user’s name (e.g. best or best regards): {your_name}
-        """,
+        """
+
+
+async def draft_reply(refined_body: str, your_name: str, sender_name: str) -> str:
+    """Generate a reply without the output guardrail (see check_reply)."""
+    result = await run_agent(
+        draft_reply_agent, input=_reply_prompt(refined_body, your_name, sender_name)
+    )
+    return result.final_output
+
+
+async def check_reply(reply: str, your_name: str, sender_name: str) -> bool:
+    """Run the reply validation (deterministic checks, then the agent) standalone."""
+    check = validate_reply(
+        reply,
+        signature_name=your_name,
+        sender_name=sender_name,
+        guardrail="email_reply_validate",
+    )
+    if check.verdict != ESCALATE:
+        return check.verdict != REJECT
+
+    result = await run_agent(
+        email_reply_validate,
+        f"reply_text: {reply}\nexpected_sender_name: {sender_name}\n"
+        f"expected_signature_name: {your_name}",
+    )
+    record_llm_verdict("email_reply_validate", result.final_output.is_valid_reply)
+    return result.final_output.is_valid_reply
+
+
+async def generate_reply(refined_body: str, your_name: str, sender_name: str) -> str:
+    try:
+        result = await run_agent(
+            reply_agent,
+            input=_reply_prompt(refined_body, your_name, sender_name),
+            context={"signature_name": your_name, "sender_name": sender_name},
         )
         print(result.final_output)
         return result.final_output
     except OutputGuardrailTripwireTriggered:
         print("Guardrail triggered — not a valid reply.")
         return "Guardrail triggered — not a valid reply."
+
+
+async def stream_reply(refined_body: str, your_name: str, sender_name: str):
+    """
+    Streaming generate_reply: yields text deltas as they arrive. The output
+    guardrail runs on the finished reply and raises
+    OutputGuardrailTripwireTriggered from here when it trips.
+    """
+    with measure_agent(reply_agent.name) as measured:
+        result = Runner.run_streamed(
+            reply_agent,
+            input=_reply_prompt(refined_body, your_name, sender_name),
+            context={"signature_name": your_name, "sender_name": sender_name},
+        )
+        async for event in result.stream_events():
+            if event.type == "raw_response_event" and isinstance(
+                event.data, ResponseTextDeltaEvent
+            ):
+                yield event.data.delta
+        measured.usage = result.context_wrapper.usage
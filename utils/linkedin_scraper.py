@@ -1,6 +1,8 @@
+import asyncio
 import os
 from serpapi import GoogleSearch
 from dotenv import load_dotenv
+from utils.singleflight import serp_flight
 
 load_dotenv()
 
@@ -48,8 +50,14 @@ def fetch_linkedin_data(linkedin_url: str):
     }
 
 
-def guardrail_linkedin_scrape(url: str):
-    data = fetch_linkedin_data(url)
+async def fetch_linkedin_data_async(linkedin_url: str):
+    # SerpAPI is blocking; concurrent lookups of the same profile share one call
+    key = extract_linkedin_username(linkedin_url).lower() or linkedin_url
+    return await serp_flight.do(key, asyncio.to_thread, fetch_linkedin_data, linkedin_url)
+
+
+async def guardrail_linkedin_scrape(url: str):
+    data = await fetch_linkedin_data_async(url)
 
     if "error" in data:
         return {"status": "fail", "message": data["error"]}
@@ -0,0 +1,111 @@
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from database.mongo import db
+from dotenv import load_dotenv
+import hashlib
+import os
+import re
+import time
+
+load_dotenv()
+
+# Results of LLM calls keyed on a hash of the normalized email content.
+# An in-memory LRU sits in front of a Mongo collection with a TTL index.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "5000"))
+LLM_CACHE_MEMORY_TTL_SECONDS = int(os.getenv("LLM_CACHE_MEMORY_TTL_SECONDS", "3600"))
+LLM_CACHE_TTL_DAYS = int(os.getenv("LLM_CACHE_TTL_DAYS", "7"))
+
+llm_cache_collection = db["llm_cache"]
+
+
+def normalize_text(text: str | None) -> str:
+    return re.sub(r"\s+", " ", (text or "").lower()).strip()
+
+
+def content_key(*parts) -> str:
+    """sha256 over the normalized parts (subject, snippet, and scope extras)."""
+    joined = "\x1f".join(normalize_text(str(p)) for p in parts)
+    return hashlib.sha256(joined.encode()).hexdigest()
+
+
+def prompt_version(*prompts: str) -> str:
+    """Short hash of an agent's instructions; part of keys so prompt edits miss."""
+    return content_key(*prompts)[:12]
+
+
+class LLMCache:
+    def __init__(self, collection, memory_size: int, memory_ttl_seconds: int, ttl_days: int):
+        self.collection = collection
+        self.memory_size = memory_size
+        self.memory_ttl = memory_ttl_seconds
+        self.ttl = timedelta(days=ttl_days)
+        self._memory = OrderedDict()  # "scope:key" -> (expires_at, value)
+        self._stats = defaultdict(lambda: {"memory_hits": 0, "db_hits": 0, "misses": 0})
+        self._index_ready = False
+
+    def _remember(self, cache_key: str, value):
+        self._memory[cache_key] = (time.monotonic() + self.memory_ttl, value)
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    async def get(self, scope: str, key: str):
+        """Return the cached value or None."""
+        if not LLM_CACHE_ENABLED:
+            return None
+        cache_key = f"{scope}:{key}"
+        entry = self._memory.get(cache_key)
+        if entry and entry[0] > time.monotonic():
+            self._memory.move_to_end(cache_key)
+            self._stats[scope]["memory_hits"] += 1
+            return entry[1]
+
+        doc = await self.collection.find_one(
+            {"_id": cache_key, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+        if doc:
+            self._remember(cache_key, doc["value"])
+            self._stats[scope]["db_hits"] += 1
+            return doc["value"]
+
+        self._stats[scope]["misses"] += 1
+        return None
+
+    async def set(self, scope: str, key: str, value):
+        if not LLM_CACHE_ENABLED:
+            return
+        cache_key = f"{scope}:{key}"
+        self._remember(cache_key, value)
+
+        if not self._index_ready:
+            await self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self._index_ready = True
+
+        await self.collection.update_one(
+            {"_id": cache_key},
+            {
+                "$set": {
+                    "scope": scope,
+                    "value": value,
+                    "expires_at": datetime.utcnow() + self.ttl,
+                }
+            },
+            upsert=True,
+        )
+
+    def stats(self) -> dict:
+        summary = {}
+        for scope, counts in self._stats.items():
+            lookups = sum(counts.values())
+            hits = counts["memory_hits"] + counts["db_hits"]
+            summary[scope] = {**counts, "hit_rate": hits / lookups if lookups else 0.0}
+        return {"memory_entries": len(self._memory), "scopes": summary}
+
+
+llm_cache = LLMCache(
+    llm_cache_collection,
+    LLM_CACHE_MEMORY_SIZE,
+    LLM_CACHE_MEMORY_TTL_SECONDS,
+    LLM_CACHE_TTL_DAYS,
+)
@@ -0,0 +1,415 @@
+import asyncio
+import os
+import random
+import time
+import weakref
+from collections import deque
+from contextvars import ContextVar
+import httpx
+from agents import Model, OpenAIChatCompletionsModel
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    RateLimitError,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# One Gemini client, HTTP pool, rate limiter and circuit breaker shared by
+# every agent in the process
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
+DEFAULT_MODEL = os.getenv("LLM_DEFAULT_MODEL", "gemini-2.0-flash")
+
+# Model tiers: agents ask for a tier, prompts bigger than the tier's input
+# limit are moved up one tier
+MODEL_TIERS = {
+    "fast": os.getenv("LLM_FAST_MODEL", "gemini-2.0-flash-lite"),
+    "default": DEFAULT_MODEL,
+    "strong": os.getenv("LLM_STRONG_MODEL", "gemini-2.5-flash"),
+}
+TIER_ORDER = ["fast", "default", "strong"]
+TIER_MAX_INPUT_TOKENS = {
+    "fast": int(os.getenv("LLM_FAST_MAX_INPUT_TOKENS", "1500")),
+    "default": int(os.getenv("LLM_DEFAULT_MAX_INPUT_TOKENS", "6000")),
+}
+
+# Hedging: a call still running after the model's LLM_HEDGE_PERCENTILE
+# latency gets a duplicate on LLM_HEDGE_BACKUP_MODEL (same model if unset),
+# the first to finish wins and the other is cancelled
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+# used until a model has LLM_HEDGE_MIN_SAMPLES latencies recorded
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "6"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "1"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_BACKUP_MODEL = os.getenv("LLM_HEDGE_BACKUP_MODEL")
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "1000"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "1000000"))
+LLM_TENANT_CONCURRENCY = int(os.getenv("LLM_TENANT_CONCURRENCY", "4"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "10"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# user the current LLM calls are made for (per asyncio task)
+current_tenant = ContextVar("llm_tenant", default=None)
+
+
+def set_llm_tenant(user_id):
+    return current_tenant.set(str(user_id) if user_id else None)
+
+
+class LLMUnavailableError(RuntimeError):
+    """Raised while the circuit breaker is open."""
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def debit(self, amount: float):
+        """Charge usage that turned out higher than estimated (may go negative)."""
+        self._refill()
+        self.tokens -= amount
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown_seconds: float):
+        self.threshold = threshold
+        self.cooldown = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise LLMUnavailableError("LLM circuit breaker is open")
+        if state == "half_open":
+            # one probe at a time; a probe that never reported back (cancelled,
+            # non-retryable error) stops blocking after another cooldown
+            now = time.monotonic()
+            if self.probe_started is not None and now - self.probe_started < self.cooldown:
+                raise LLMUnavailableError("LLM circuit breaker is half-open, probe in flight")
+            self.probe_started = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold or self.state == "half_open":
+            self.opened_at = time.monotonic()
+        self.probe_started = None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(30.0, 0.5 * 2**attempt))
+
+
+def estimate_tokens(*parts) -> int:
+    # ~4 characters per token is close enough for rate limiting
+    return max(1, sum(len(str(p)) for p in parts if p) // 4)
+
+
+def _prompt_tokens(args, kwargs) -> int:
+    # Model.get_response/stream_response(system_instructions, input, ...)
+    system_instructions = kwargs.get("system_instructions", args[0] if args else None)
+    input = kwargs.get("input", args[1] if len(args) > 1 else None)
+    return estimate_tokens(system_instructions, input)
+
+
+class LatencyTracker:
+    """Recent successful call latencies of one model."""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+        self._sorted = None
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, pct: float) -> float | None:
+        if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * pct))]
+
+
+class LLMGateway:
+    def __init__(self):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=10.0),
+        )
+        # retries are done here, with the rate limiter and breaker in the loop
+        self.client = AsyncOpenAI(
+            api_key=GEMINI_API_KEY,
+            base_url=GEMINI_BASE_URL,
+            http_client=self.http_client,
+            max_retries=0,
+        )
+        self.rpm = TokenBucket(LLM_RPM_LIMIT)
+        self.tpm = TokenBucket(LLM_TPM_LIMIT)
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS)
+        self._tenant_limits = weakref.WeakValueDictionary()
+        self.latency = {}  # model name -> LatencyTracker
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record_latency(self, model: str, seconds: float):
+        tracker = self.latency.get(model)
+        if tracker is None:
+            tracker = self.latency[model] = LatencyTracker()
+        tracker.add(seconds)
+
+    def hedge_delay(self, model: str) -> float:
+        tracker = self.latency.get(model)
+        observed = tracker.percentile(LLM_HEDGE_PERCENTILE) if tracker else None
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, observed or LLM_HEDGE_AFTER_SECONDS)
+
+    def _tenant_limit(self, tenant) -> asyncio.Semaphore:
+        key = tenant or "_shared"
+        limit = self._tenant_limits.get(key)
+        if limit is None:
+            limit = asyncio.Semaphore(LLM_TENANT_CONCURRENCY)
+            self._tenant_limits[key] = limit
+        return limit
+
+    async def admit(self, estimated_tokens: int):
+        self.breaker.before_call()
+        await self.rpm.acquire(1)
+        await self.tpm.acquire(estimated_tokens)
+
+    async def call(self, fn, estimated_tokens: int, model: str | None = None, admitted=None):
+        """
+        Run `fn()` (one model request) under the per-tenant cap and the global
+        RPM/TPM buckets, retrying 429/5xx/connection errors with jitter.
+
+        The latency of successful requests is recorded for `model`, without
+        the time spent waiting in the limiters or backing off. `admitted`
+        (an asyncio.Event) is set once the first request is let through.
+        """
+        tenant_limit = self._tenant_limit(current_tenant.get())
+        attempt = 0
+        while True:
+            async with tenant_limit:
+                await self.admit(estimated_tokens)
+                if admitted is not None:
+                    admitted.set()
+                start = time.monotonic()
+                try:
+                    response = await fn()
+                except Exception as e:
+                    if not _is_retryable(e):
+                        raise
+                    self.breaker.record_failure()
+                    if attempt >= LLM_MAX_RETRIES:
+                        raise
+                    delay = _retry_delay(e, attempt)
+                    error_name = type(e).__name__
+                else:
+                    self.breaker.record_success()
+                    if model is not None:
+                        self.record_latency(model, time.monotonic() - start)
+                    usage = getattr(response, "usage", None)
+                    actual = getattr(usage, "total_tokens", 0) or 0
+                    if actual > estimated_tokens:
+                        self.tpm.debit(actual - estimated_tokens)
+                    return response
+
+            attempt += 1
+            print(f"⏳ LLM call failed ({error_name}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.http_client.aclose()
+
+
+gateway = LLMGateway()
+
+
+class GatewayModel(OpenAIChatCompletionsModel):
+    """Chat completions model whose requests all go through the gateway."""
+
+    async def get_response(self, *args, **kwargs):
+        return await self.request(args, kwargs)
+
+    async def request(self, args, kwargs, admitted=None):
+        """get_response, setting the `admitted` event once the gateway lets it through."""
+        return await gateway.call(
+            lambda: OpenAIChatCompletionsModel.get_response(self, *args, **kwargs),
+            _prompt_tokens(args, kwargs),
+            model=self.model,
+            admitted=admitted,
+        )
+
+    async def stream_response(self, *args, **kwargs):
+        # a stream can't be replayed, so it is admitted once and not retried
+        async with gateway._tenant_limit(current_tenant.get()):
+            await gateway.admit(_prompt_tokens(args, kwargs))
+            try:
+                async for event in OpenAIChatCompletionsModel.stream_response(
+                    self, *args, **kwargs
+                ):
+                    yield event
+            except Exception as e:
+                if _is_retryable(e):
+                    gateway.breaker.record_failure()
+                raise
+            gateway.breaker.record_success()
+
+
+_models = {}
+
+
+def _gateway_model(name: str) -> GatewayModel:
+    model = _models.get(name)
+    if model is None:
+        model = _models[name] = GatewayModel(model=name, openai_client=gateway.client)
+    return model
+
+
+class RoutedModel(Model):
+    """
+    Picks the concrete model per call from the agent's tier and the prompt
+    size, and hedges slow non-streaming calls.
+    """
+
+    def __init__(self, tier: str, escalate_above: int | None = None):
+        self.tier = tier
+        self.escalate_above = escalate_above or TIER_MAX_INPUT_TOKENS.get(tier)
+
+    def route(self, args, kwargs) -> GatewayModel:
+        index = TIER_ORDER.index(self.tier)
+        limit = self.escalate_above if self.tier != TIER_ORDER[-1] else None
+        if limit is not None and _prompt_tokens(args, kwargs) > limit:
+            index += 1
+        return _gateway_model(MODEL_TIERS[TIER_ORDER[index]])
+
+    async def get_response(self, *args, **kwargs):
+        primary = self.route(args, kwargs)
+        if not LLM_HEDGE_ENABLED or gateway.breaker.state != "closed":
+            return await primary.get_response(*args, **kwargs)
+
+        admitted = asyncio.Event()
+        first = asyncio.ensure_future(primary.request(args, kwargs, admitted))
+        tasks = [first]
+        try:
+            # the hedge timer starts once the primary is past the tenant cap
+            # and the limiters, not while it is still queued behind them
+            waiter = asyncio.ensure_future(admitted.wait())
+            try:
+                await asyncio.wait([first, waiter], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            if not first.done():
+                await asyncio.wait(tasks, timeout=gateway.hedge_delay(primary.model))
+            if first.done():
+                return first.result()
+
+            backup = _gateway_model(LLM_HEDGE_BACKUP_MODEL or primary.model)
+            tasks.append(asyncio.ensure_future(backup.get_response(*args, **kwargs)))
+            gateway.hedges += 1
+
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            gateway.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # cancel the loser (or both, if we were cancelled ourselves)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream_response(self, *args, **kwargs):
+        async for event in self.route(args, kwargs).stream_response(*args, **kwargs):
+            yield event
+
+
+def get_model(tier: str = "default", escalate_above: int | None = None) -> RoutedModel:
+    """
+    Model for an agent of the given tier ("fast" | "default" | "strong").
+    `escalate_above` overrides the tier's input token limit for moving up.
+    """
+    return RoutedModel(tier, escalate_above)
+
+
+def gateway_stats() -> dict:
+    return {
+        "breaker": gateway.breaker.state,
+        "consecutive_failures": gateway.breaker.failures,
+        "rpm_tokens_available": round(gateway.rpm.tokens, 1),
+        "tpm_tokens_available": round(gateway.tpm.tokens, 1),
+        "hedges": gateway.hedges,
+        "hedge_wins": gateway.hedge_wins,
+        "latency_p50": {
+            name: tracker.percentile(0.5) for name, tracker in gateway.latency.items()
+        },
+        "latency_p95": {
+            name: tracker.percentile(0.95) for name, tracker in gateway.latency.items()
+        },
+    }
@@ -0,0 +1,212 @@
+import bisect
+import os
+import time
+from collections import OrderedDict, defaultdict
+from agents import Runner, OutputGuardrailTripwireTriggered
+from dotenv import load_dotenv
+from utils.llm_gateway import current_tenant
+
+load_dotenv()
+
+# Per-agent / per-user LLM usage kept in process memory: plain counters
+# updated once per agent run, no locks or I/O on the request path.
+# USD per million tokens, defaults are gemini-2.0-flash list prices
+LLM_PRICE_INPUT_PER_MTOK = float(os.getenv("LLM_PRICE_INPUT_PER_MTOK", "0.10"))
+LLM_PRICE_OUTPUT_PER_MTOK = float(os.getenv("LLM_PRICE_OUTPUT_PER_MTOK", "0.40"))
+# at most this many (user, agent) series are kept, least recently used go
+# first (per-agent totals are unaffected)
+LLM_METRICS_MAX_USER_SERIES = int(os.getenv("LLM_METRICS_MAX_USER_SERIES", "1000"))
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+OUTCOMES = ("ok", "guardrail_tripped", "error")
+
+
+def _cost(input_tokens: int, output_tokens: int) -> float:
+    return (
+        input_tokens * LLM_PRICE_INPUT_PER_MTOK
+        + output_tokens * LLM_PRICE_OUTPUT_PER_MTOK
+    ) / 1_000_000
+
+
+class _AgentStats:
+    __slots__ = ("outcomes", "buckets", "latency_sum", "requests", "input_tokens", "output_tokens")
+
+    def __init__(self):
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.latency_sum = 0.0
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    @property
+    def calls(self) -> int:
+        return sum(self.outcomes.values())
+
+    def percentile(self, pct: float) -> float | None:
+        """Upper bucket bound holding the pct-th call (None if no calls)."""
+        target = self.calls * pct
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+
+class LLMMetrics:
+    def __init__(self):
+        self.agents = defaultdict(_AgentStats)
+        # (user_id, agent) -> [calls, input_tokens, output_tokens, errors]
+        self.users = OrderedDict()
+        self.evicted_user_series = 0
+
+    def record(self, agent: str, seconds: float, outcome: str, usage=None):
+        stats = self.agents[agent]
+        stats.outcomes[outcome] += 1
+        stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        stats.latency_sum += seconds
+
+        input_tokens = getattr(usage, "input_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        stats.requests += getattr(usage, "requests", 0) or 0
+        stats.input_tokens += input_tokens
+        stats.output_tokens += output_tokens
+
+        key = (current_tenant.get() or "-", agent)
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = [0, 0, 0, 0]
+            if len(self.users) > LLM_METRICS_MAX_USER_SERIES:
+                self.users.popitem(last=False)
+                self.evicted_user_series += 1
+        else:
+            self.users.move_to_end(key)
+        user[0] += 1
+        user[1] += input_tokens
+        user[2] += output_tokens
+        user[3] += outcome == "error"
+
+    def summary(self) -> dict:
+        agents = {}
+        for name, stats in sorted(self.agents.items()):
+            calls = stats.calls
+            agents[name] = {
+                "calls": calls,
+                **stats.outcomes,
+                "guardrail_trip_rate": stats.outcomes["guardrail_tripped"] / calls if calls else 0.0,
+                "latency_avg": stats.latency_sum / calls if calls else None,
+                "latency_p50": stats.percentile(0.5),
+                "latency_p95": stats.percentile(0.95),
+                "model_requests": stats.requests,
+                "input_tokens": stats.input_tokens,
+                "output_tokens": stats.output_tokens,
+                "cost_usd": round(_cost(stats.input_tokens, stats.output_tokens), 6),
+            }
+
+        users = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0, "errors": 0, "cost_usd": 0.0})
+        for (user_id, _), (calls, input_tokens, output_tokens, errors) in self.users.items():
+            entry = users[user_id]
+            entry["calls"] += calls
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["errors"] += errors
+            entry["cost_usd"] = round(_cost(entry["input_tokens"], entry["output_tokens"]), 6)
+        return {
+            "agents": agents,
+            "users": dict(users),
+            "evicted_user_series": self.evicted_user_series,
+        }
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP llm_agent_runs_total Agent runs by outcome.",
+            "# TYPE llm_agent_runs_total counter",
+        ]
+        for name, stats in sorted(self.agents.items()):
+            for outcome, count in stats.outcomes.items():
+                lines.append(f'llm_agent_runs_total{{agent="{_esc(name)}",outcome="{outcome}"}} {count}')
+
+        lines += [
+            "# HELP llm_agent_run_seconds Agent run latency (includes tool calls).",
+            "# TYPE llm_agent_run_seconds histogram",
+        ]
+        for name, stats in sorted(self.agents.items()):
+            label = f'agent="{_esc(name)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'llm_agent_run_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'llm_agent_run_seconds_bucket{{{label},le="+Inf"}} {stats.calls}')
+            lines.append(f"llm_agent_run_seconds_sum{{{label}}} {stats.latency_sum:.6f}")
+            lines.append(f"llm_agent_run_seconds_count{{{label}}} {stats.calls}")
+
+        lines += [
+            "# HELP llm_agent_tokens_total Tokens used by agent runs.",
+            "# TYPE llm_agent_tokens_total counter",
+        ]
+        for name, stats in sorted(self.agents.items()):
+            lines.append(f'llm_agent_tokens_total{{agent="{_esc(name)}",type="input"}} {stats.input_tokens}')
+            lines.append(f'llm_agent_tokens_total{{agent="{_esc(name)}",type="output"}} {stats.output_tokens}')
+
+        lines += [
+            "# HELP llm_agent_cost_usd_total Estimated spend of agent runs.",
+            "# TYPE llm_agent_cost_usd_total counter",
+        ]
+        for name, stats in sorted(self.agents.items()):
+            cost = _cost(stats.input_tokens, stats.output_tokens)
+            lines.append(f'llm_agent_cost_usd_total{{agent="{_esc(name)}"}} {cost:.6f}')
+
+        lines += [
+            "# HELP llm_user_tokens_total Tokens used per user and agent.",
+            "# TYPE llm_user_tokens_total counter",
+        ]
+        for (user_id, name), (_, input_tokens, output_tokens, _) in list(self.users.items()):
+            label = f'user="{_esc(user_id)}",agent="{_esc(name)}"'
+            lines.append(f'llm_user_tokens_total{{{label},type="input"}} {input_tokens}')
+            lines.append(f'llm_user_tokens_total{{{label},type="output"}} {output_tokens}')
+        return "\n".join(lines) + "\n"
+
+
+def _esc(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+llm_metrics = LLMMetrics()
+
+
+class measure_agent:
+    """
+    Times one agent run and records it on exit. Set `.usage` to the run's
+    `context_wrapper.usage` before leaving the block.
+    """
+
+    def __init__(self, agent_name: str):
+        self.agent_name = agent_name
+        self.usage = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and not issubclass(exc_type, Exception):
+            return False  # cancelled / generator closed, not a failed call
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, OutputGuardrailTripwireTriggered):
+            outcome = "guardrail_tripped"
+        else:
+            outcome = "error"
+        llm_metrics.record(
+            self.agent_name, time.perf_counter() - self.start, outcome, self.usage
+        )
+        return False
+
+
+async def run_agent(agent, input, **kwargs):
+    """Runner.run with latency/token/outcome metrics recorded for `agent`."""
+    with measure_agent(agent.name) as measured:
+        result = await Runner.run(agent, input=input, **kwargs)
+        measured.usage = result.context_wrapper.usage
+    return result
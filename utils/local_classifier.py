@@ -0,0 +1,246 @@
+"""
+Local junk/easy/hard pre-classifier.
+
+Multinomial naive Bayes over hashed word unigrams/bigrams of the subject,
+snippet and sender domain, trained offline from the labelled `emails`
+(easy/junk) and `hard_emails` collections. `process_email` only trusts it
+when the top class probability reaches LOCAL_CLASSIFIER_THRESHOLD; anything
+less confident still goes to the LLM.
+
+    python -m utils.local_classifier train
+    python -m utils.local_classifier evaluate
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import zlib
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOCAL_CLASSIFIER_PATH = os.getenv("LOCAL_CLASSIFIER_PATH", "data/local_classifier.npz")
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.97"))
+
+N_FEATURES = 2**18
+CLASSES = ["junk", "easy", "hard"]
+# every document gets this token, so no row is ever empty
+BIAS_TOKEN = "__bias__"
+
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+
+def sender_domain(sender: str) -> str:
+    match = re.search(r"@([\w.-]+)", sender or "")
+    return match.group(1).lower() if match else ""
+
+
+def tokenize(subject: str, body: str, sender: str) -> list[str]:
+    words = _TOKEN_RE.findall(f"{subject or ''} {body or ''}".lower())
+    tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    tokens.append(f"subj_len:{min(len((subject or '').split()), 10)}")
+    domain = sender_domain(sender)
+    if domain:
+        tokens.append(f"dom:{domain}")
+    tokens.append(BIAS_TOKEN)
+    return tokens
+
+
+def _hash(token: str) -> int:
+    # crc32 is stable across processes, unlike hash()
+    return zlib.crc32(token.encode()) % N_FEATURES
+
+
+def vectorize(emails: list[dict]):
+    """
+    Hash a batch of emails ({subject, snippet, sender}) into a CSR-like
+    (indices, counts, offsets) triple.
+    """
+    indices, counts, offsets = [], [], []
+    for email in emails:
+        offsets.append(len(indices))
+        hashed = np.fromiter(
+            (_hash(t) for t in tokenize(email.get("subject"), email.get("snippet"), email.get("sender"))),
+            dtype=np.int64,
+        )
+        unique, freq = np.unique(hashed, return_counts=True)
+        indices.extend(unique)
+        counts.extend(freq)
+    return (
+        np.asarray(indices, dtype=np.int64),
+        np.asarray(counts, dtype=np.float64),
+        np.asarray(offsets, dtype=np.int64),
+    )
+
+
+class LocalClassifier:
+    def __init__(self, log_prior: np.ndarray, log_prob: np.ndarray):
+        self.log_prior = log_prior  # (n_classes,)
+        self.log_prob = log_prob  # (n_classes, N_FEATURES)
+
+    @classmethod
+    def train(cls, emails: list[dict], labels: list[str], alpha: float = 0.5):
+        indices, counts, offsets = vectorize(emails)
+        label_ids = np.asarray([CLASSES.index(label) for label in labels])
+        row_of = np.repeat(np.arange(len(emails)), np.diff(np.append(offsets, len(indices))))
+
+        feature_count = np.zeros((len(CLASSES), N_FEATURES))
+        np.add.at(feature_count, (label_ids[row_of], indices), counts)
+        class_count = np.bincount(label_ids, minlength=len(CLASSES)).astype(np.float64)
+
+        smoothed = feature_count + alpha
+        log_prob = np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+        log_prior = np.log((class_count + 1) / (class_count.sum() + len(CLASSES)))
+        return cls(log_prior, log_prob)
+
+    def predict_proba(self, emails: list[dict]) -> np.ndarray:
+        """Vectorized scoring, returns (n_emails, n_classes) probabilities."""
+        if not emails:
+            return np.zeros((0, len(CLASSES)))
+        indices, counts, offsets = vectorize(emails)
+        contrib = self.log_prob[:, indices] * counts  # (n_classes, nnz)
+        joint = np.add.reduceat(contrib, offsets, axis=1).T + self.log_prior
+        joint -= joint.max(axis=1, keepdims=True)
+        proba = np.exp(joint)
+        return proba / proba.sum(axis=1, keepdims=True)
+
+    def predict(self, emails: list[dict]):
+        proba = self.predict_proba(emails)
+        best = proba.argmax(axis=1)
+        return [(CLASSES[i], float(proba[row, i])) for row, i in enumerate(best)]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, log_prior=self.log_prior, log_prob=self.log_prob)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(data["log_prior"], data["log_prob"])
+
+
+_model = None
+_model_mtime = None
+
+
+def get_local_classifier():
+    """Load (and reload after retraining) the model from disk, None if absent."""
+    global _model, _model_mtime
+    try:
+        mtime = os.path.getmtime(LOCAL_CLASSIFIER_PATH)
+    except OSError:
+        return None
+    if _model is None or mtime != _model_mtime:
+        _model = LocalClassifier.load(LOCAL_CLASSIFIER_PATH)
+        _model_mtime = mtime
+    return _model
+
+
+def predict_confident(email: dict, threshold: float | None = None):
+    """Return "junk" / "easy" / "hard" when the model is confident, else None."""
+    model = get_local_classifier()
+    if model is None:
+        return None
+    label, probability = model.predict([email])[0]
+    if threshold is None:
+        threshold = LOCAL_CLASSIFIER_THRESHOLD
+    if probability >= threshold:
+        return label
+    return None
+
+
+# ---------- Offline training / evaluation ----------
+async def load_training_data(limit: int | None = None):
+    from models.emails import emails
+    from models.hard_email import hard_emails
+    from utils.bulk_mail_filter import is_bulk_reason
+    from utils.sender_reputation import GUARDRAIL_FAILED_REASON, is_reputation_reason
+
+    # same rows the sender reputation rebuild leaves out: decisions made
+    # without the LLM from the sender's history or headers (training on
+    # them feeds those back in) and easy emails whose draft failed
+    samples, labels = [], []
+    async for doc in emails.find({"status": {"$in": ["easy", "junk"]}}).limit(limit or 0):
+        reason = doc.get("reason")
+        if is_reputation_reason(reason) or is_bulk_reason(reason):
+            continue
+        samples.append(
+            {
+                "subject": doc.get("subject", ""),
+                "snippet": doc.get("snippet", ""),
+                "sender": doc.get("to_email", ""),
+            }
+        )
+        labels.append(doc["status"])
+    async for doc in hard_emails.find({"type": "inbound"}).limit(limit or 0):
+        reason = doc.get("reason")
+        if is_reputation_reason(reason) or reason == GUARDRAIL_FAILED_REASON:
+            continue
+        samples.append(
+            {
+                "subject": doc.get("subject", ""),
+                "snippet": doc.get("snippet", ""),
+                "sender": doc.get("sender", ""),
+            }
+        )
+        labels.append("hard")
+    return samples, labels
+
+
+def evaluate(model: LocalClassifier, samples, labels, threshold: float):
+    predictions = model.predict(samples)
+    correct = sum(p == y for (p, _), y in zip(predictions, labels))
+    confident = [(p, y) for (p, prob), y in zip(predictions, labels) if prob >= threshold]
+    confident_correct = sum(p == y for p, y in confident)
+
+    print(f"samples:            {len(labels)}")
+    print(f"accuracy:           {correct / len(labels):.1%}")
+    print(f"threshold:          {threshold}")
+    print(f"coverage:           {len(confident) / len(labels):.1%} (LLM skipped)")
+    if confident:
+        print(f"confident accuracy: {confident_correct / len(confident):.1%}")
+    for cls in CLASSES:
+        tp = sum(p == cls and y == cls for (p, _), y in zip(predictions, labels))
+        predicted = sum(p == cls for p, _ in predictions)
+        actual = sum(y == cls for y in labels)
+        precision = tp / predicted if predicted else 0.0
+        recall = tp / actual if actual else 0.0
+        print(f"  {cls:5} precision={precision:.1%} recall={recall:.1%} n={actual}")
+
+
+def _split(samples, labels, holdout: float, seed: int = 42):
+    order = np.random.default_rng(seed).permutation(len(labels))
+    cut = int(len(labels) * (1 - holdout))
+    pick = lambda idx: ([samples[i] for i in idx], [labels[i] for i in idx])  # noqa: E731
+    return pick(order[:cut]), pick(order[cut:])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Train / evaluate the local email classifier")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--model", default=LOCAL_CLASSIFIER_PATH)
+    parser.add_argument("--threshold", type=float, default=LOCAL_CLASSIFIER_THRESHOLD)
+    parser.add_argument("--holdout", type=float, default=0.2)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    samples, labels = await load_training_data(args.limit)
+    if not labels:
+        print("No labelled emails found")
+        return
+
+    if args.command == "train":
+        (train_x, train_y), (test_x, test_y) = _split(samples, labels, args.holdout)
+        if test_y:
+            evaluate(LocalClassifier.train(train_x, train_y), test_x, test_y, args.threshold)
+        # ship a model trained on everything
+        LocalClassifier.train(samples, labels).save(args.model)
+        print(f"✅ Model saved to {args.model}")
+    else:
+        evaluate(LocalClassifier.load(args.model), samples, labels, args.threshold)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,75 +1,231 @@
 from datetime import datetime
-from pymongo import ReturnDocument
 from bson import ObjectId
 from config.limit import PLAN_LIMITS  # map your limits into python
 from models.users import users
+from dotenv import load_dotenv
+import asyncio
+import os
+import time
+import weakref
 
+load_dotenv()
 
-async def ensure_usage_reset(user_doc):
-    # reset usage if lastReset is in previous month
-    last = user_doc.get("usage", {}).get("lastReset")
-    if not last:
-        return
-    now = datetime.utcnow()
-    if last.year != now.year or last.month != now.month:
-        await users.update_one(
-            {"_id": user_doc["_id"]},
-            {
-                "$set": {
-                    "usage.emailAnalyses": 0,
-                    "usage.autoReplies": 0,
-                    "usage.sequencesCreated": 0,
-                    "usage.contactsImported": 0,
-                    "usage.lastReset": now,
-                }
-            },
-        )
+# Lease quota in blocks of this size per user/resource so hot mailboxes don't
+# write to Mongo on every email (0 disables leasing)
+QUOTA_LEASE_SIZE = int(os.getenv("QUOTA_LEASE_SIZE", "0"))
+# Unused leased quota is given up (stays counted) after this long
+QUOTA_LEASE_TTL_SECONDS = int(os.getenv("QUOTA_LEASE_TTL_SECONDS", "600"))
+LEASED_RESOURCES = {"emailAnalyses", "autoReplies"}
 
+LIMIT_KEY_MAP = {
+    "emailAnalyses": "emailAnalysesPerMonth",
+    "autoReplies": "autoRepliesPerMonth",
+    "sequencesCreated": "sequences",
+    "contactsImported": "contacts",
+}
 
-async def try_consume_quota(user_id: str, resource: str, amount: int = 1) -> bool:
-    user_obj_id = ObjectId(user_id)
-    user = await users.find_one({"_id": user_obj_id})
-    if not user:
-        return False
 
-    await ensure_usage_reset(user)
+# Python truthiness of isProUser, as the plan was always read (1, "true"... are pro)
+FALSY_PLAN_VALUES = [False, None, 0, ""]
+PRO_MATCH = {"isProUser": {"$nin": FALSY_PLAN_VALUES}}
+FREE_MATCH = {"isProUser": {"$in": FALSY_PLAN_VALUES}}  # None also matches missing
+
+
+def usage_period(now: datetime | None = None) -> str:
+    # counters live under usage.<YYYY-MM>.<resource>, so a new month simply
+    # starts from a fresh (missing) counter and no reset step is needed
+    return (now or datetime.utcnow()).strftime("%Y-%m")
+
+
+def _usage_field(resource: str, period: str) -> str:
+    return f"usage.{period}.{resource}"
+
+
+# (user_id, resource, period) already seeded by this process
+_seeded = set()
+
 
-    # Ensure usage dict exists
-    usage = user.get("usage", {})
-    if resource not in usage:
-        # Initialize missing field to 0
-        await users.update_one(
-            {"_id": user_obj_id},
-            {"$set": {f"usage.{resource}": 0, "usage.lastReset": datetime.utcnow()}},
+async def _seed_period(user_id: str, resource: str, period: str):
+    """
+    Start a missing period counter from the flat usage.<resource> counter
+    when usage.lastReset falls in the same month, so usage from before the
+    period counters existed still counts. Starting a new month resets the
+    flat counters (and lastReset) the way ensure_usage_reset used to; they
+    are kept up to date for anything else still reading them.
+    """
+    key = (str(user_id), resource, period)
+    if key in _seeded:
+        return
+    field = _usage_field(resource, period)
+    for _ in range(3):
+        user = await users.find_one({"_id": ObjectId(user_id)}, {"usage": 1})
+        if not user:
+            return
+        usage = user.get("usage") or {}
+        if (usage.get(period) or {}).get(resource) is not None:
+            break
+        last = usage.get("lastReset")
+        update = {field: 0}
+        if last and usage_period(last) == period:
+            update[field] = usage.get(resource, 0)
+        else:
+            update.update({f"usage.{r}": 0 for r in LIMIT_KEY_MAP})
+            update["usage.lastReset"] = datetime.utcnow()
+        # only if nobody seeded or reset in between, else read again
+        res = await users.update_one(
+            {"_id": ObjectId(user_id), field: {"$exists": False}, "usage.lastReset": last},
+            {"$set": update},
         )
-        usage[resource] = 0
+        if res.modified_count:
+            break
+    if len(_seeded) > 100000:
+        _seeded.clear()  # only costs one extra read per user on the next consume
+    _seeded.add(key)
+
 
-    plan = "pro" if user.get("isProUser") else "free"
+def _allowed(is_pro: bool, resource: str):
+    plan = "pro" if is_pro else "free"
     limits = PLAN_LIMITS.get(plan, PLAN_LIMITS["free"])
+    # treat None as unlimited
+    return limits.get(LIMIT_KEY_MAP[resource])
 
-    limit_key_map = {
-        "emailAnalyses": "emailAnalysesPerMonth",
-        "autoReplies": "autoRepliesPerMonth",
-        "sequencesCreated": "sequences",
-        "contactsImported": "contacts",
-    }
-    limit_key = limit_key_map[resource]
-    allowed = limits.get(limit_key)
 
-    # treat None as unlimited
-    if allowed is None:
-        await users.update_one(
-            {"_id": user_obj_id}, {"$inc": {f"usage.{resource}": amount}}
-        )
-        return True
+async def _consume_atomic(user_id: str, resource: str, amount: int) -> bool:
+    """Check the plan limit and increment the counter in one find_one_and_update."""
+    period = usage_period()
+    await _seed_period(user_id, resource, period)
+    field = _usage_field(resource, period)
 
-    # fix: use $lt instead of $lte - amount
-    filter_q = {"_id": user_obj_id, f"usage.{resource}": {"$lt": allowed}}
-    update_q = {"$inc": {f"usage.{resource}": amount}}
+    # one clause per plan, so the plan lookup is part of the same atomic filter
+    clauses = []
+    for is_pro in (True, False):
+        plan_match = PRO_MATCH if is_pro else FREE_MATCH
+        allowed = _allowed(is_pro, resource)
+        if allowed is None:
+            clauses.append(plan_match)
+        else:
+            # $not/$gt also matches a missing counter (nothing used yet)
+            clauses.append({**plan_match, field: {"$not": {"$gt": allowed - amount}}})
 
     res = await users.find_one_and_update(
-        filter_q, update_q, return_document=ReturnDocument.AFTER
+        {"_id": ObjectId(user_id), "$or": clauses},
+        {"$inc": {field: amount, f"usage.{resource}": amount}},
+        projection={"_id": 1},
     )
-
     return res is not None
 
+
+async def consume_up_to(user_id: str, resource: str, amount: int) -> int:
+    """
+    Consume as much of `amount` as the plan still allows and return how many
+    units were granted (0 when the quota is exhausted). Meant for bulk paths.
+    """
+    period = usage_period()
+    await _seed_period(user_id, resource, period)
+    for _ in range(5):
+        user = await users.find_one(
+            {"_id": ObjectId(user_id)},
+            {"isProUser": 1, _usage_field(resource, period): 1},
+        )
+        if not user:
+            return 0
+
+        allowed = _allowed(user.get("isProUser"), resource)
+        used = user.get("usage", {}).get(period, {}).get(resource, 0)
+        grant = amount if allowed is None else max(0, min(amount, allowed - used))
+        if grant == 0:
+            return 0
+
+        # the atomic consume re-checks the limit, retry if someone raced us
+        if await _consume_atomic(user_id, resource, grant):
+            return grant
+    return 0
+
+
+async def remaining_quota(user_id: str, resource: str) -> int | None:
+    """
+    Units still available this period without consuming any, counting
+    quota already leased to this process. None means unlimited.
+    """
+    period = usage_period()
+    await _seed_period(user_id, resource, period)
+    user = await users.find_one(
+        {"_id": ObjectId(user_id)},
+        {"isProUser": 1, _usage_field(resource, period): 1},
+    )
+    if not user:
+        return 0
+    allowed = _allowed(user.get("isProUser"), resource)
+    if allowed is None:
+        return None
+    used = user.get("usage", {}).get(period, {}).get(resource, 0)
+    leased = 0
+    if QUOTA_LEASE_SIZE > 0 and resource in LEASED_RESOURCES:
+        leased = quota_leases.leased(user_id, resource)
+    return max(0, allowed - used) + leased
+
+
+class QuotaLeaseCache:
+    """
+    Hands out quota from small blocks leased per user/resource/month, so only
+    one in `lease_size` consumes hits the database.
+    """
+
+    def __init__(self, lease_size: int, ttl_seconds: int):
+        self.lease_size = lease_size
+        self.ttl_seconds = ttl_seconds
+        self._leases = {}  # (user_id, resource, period) -> [remaining, expires_at]
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock(self, key) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def consume(self, user_id: str, resource: str, amount: int = 1) -> bool:
+        key = (str(user_id), resource, usage_period())
+        async with self._lock(key):
+            now = time.monotonic()
+            lease = self._leases.get(key)
+            remaining = lease[0] if lease and lease[1] > now else 0
+
+            if remaining < amount:
+                granted = await consume_up_to(
+                    user_id, resource, max(amount - remaining, self.lease_size)
+                )
+                remaining += granted
+
+            if remaining < amount:
+                self._leases[key] = [remaining, now + self.ttl_seconds]
+                return False
+
+            self._leases[key] = [remaining - amount, now + self.ttl_seconds]
+            self._prune(now)
+            return True
+
+    def leased(self, user_id: str, resource: str) -> int:
+        """Units left in this process's live lease."""
+        lease = self._leases.get((str(user_id), resource, usage_period()))
+        return lease[0] if lease and lease[1] > time.monotonic() else 0
+
+    def _prune(self, now: float):
+        if len(self._leases) < 10000:
+            return
+        for key in [k for k, lease in self._leases.items() if lease[1] <= now]:
+            del self._leases[key]
+
+    def release(self, user_id: str):
+        """Forget leases for a user (e.g. after a plan change)."""
+        for key in [k for k in self._leases if k[0] == str(user_id)]:
+            del self._leases[key]
+
+
+quota_leases = QuotaLeaseCache(QUOTA_LEASE_SIZE, QUOTA_LEASE_TTL_SECONDS)
+
+
+async def try_consume_quota(user_id: str, resource: str, amount: int = 1) -> bool:
+    if QUOTA_LEASE_SIZE > 0 and resource in LEASED_RESOURCES:
+        return await quota_leases.consume(user_id, resource, amount)
+    return await _consume_atomic(user_id, resource, amount)
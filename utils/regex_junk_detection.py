@@ -1,4 +1,9 @@
+import asyncio
+import os
 import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
 
 SPAM_KEYWORDS = [
     r"congratulations", r"lottery", r"you won", r"winner",
@@ -11,35 +16,244 @@ BAD_DOMAINS = [
     "cheapoffers.com", "randommail.ru", "tempmail", "nigerian-prince",
 ]
 
-def is_junk_email(input_text: str) -> bool:
-    # Extract fields
-    subject_match = re.search(r"Subject:\s*(.*)", input_text)
-    from_match = re.search(r"From:\s*(.*)", input_text)
-    body_match = re.search(r"Body:\s*(.*)", input_text, re.DOTALL)
+# Extra rules and per-user allow/deny lists live in this collection:
+#   {kind: "keyword" | "domain" | "sender", value, action: "deny" | "allow",
+#    user_id: <optional, global rule when missing>, enabled: <default true>}
+JUNK_RULES_COLLECTION = os.getenv("JUNK_RULES_COLLECTION", "junk_rules")
+JUNK_RULES_RELOAD_SECONDS = int(os.getenv("JUNK_RULES_RELOAD_SECONDS", "60"))
 
-    subject = subject_match.group(1).strip() if subject_match else ""
-    sender = from_match.group(1).strip() if from_match else ""
-    body = body_match.group(1).strip() if body_match else ""
+MAX_LINKS = 3
+_FIELDS_RE = re.compile(
+    r"Subject:\s*(?P<subject>.*)|From:\s*(?P<sender>.*)|Body:\s*(?P<body>(?s:.*))"
+)
+_ADDRESS_RE = re.compile(r"([\w.+-]+@([\w-]+(?:\.[\w-]+)+))")
 
-    text = f"{subject} {body}".lower()
 
-    # Keyword-based detection
-    for kw in SPAM_KEYWORDS:
-        if re.search(kw, text):
-            return True
+@dataclass(frozen=True)
+class JunkVerdict:
+    is_junk: bool
+    hits: tuple[str, ...] = ()
 
-    # Suspicious sender domains
-    sender = sender.lower()
-    if any(domain in sender for domain in BAD_DOMAINS):
-        return True
 
-    # Too many links
-    if text.count("http") > 3:
-        return True
+def parse_sender(sender: str) -> tuple[str, str]:
+    """'Name <a@b.com>' → ('a@b.com', 'b.com'), lowercased."""
+    match = _ADDRESS_RE.search(sender or "")
+    if not match:
+        return "", ""
+    return match.group(1).lower(), match.group(2).lower()
 
-    # ALL CAPS subject
-    if subject.isupper() and len(subject.split()) > 3:
-        return True
 
-    return False
+def parse_input_text(input_text: str) -> dict:
+    """Split the flattened 'Subject/From/Body' text into fields in one pass."""
+    fields = {"subject": "", "sender": "", "body": ""}
+    for match in _FIELDS_RE.finditer(input_text):
+        name = match.lastgroup
+        if not fields[name]:
+            fields[name] = match.group(name).strip()
+    return fields
 
+
+@dataclass
+class _RuleSet:
+    keywords: list = field(default_factory=list)
+    domains: set = field(default_factory=set)  # full domains, matched by suffix
+    domain_fragments: list = field(default_factory=list)  # no dot: substring of the domain
+    senders: set = field(default_factory=set)
+
+    def compile(self):
+        # one alternation for all keywords; no named groups, they would turn
+        # off re's literal-prefix optimisations and make it ~20x slower
+        self.keyword_re = (
+            re.compile("|".join(f"(?:{kw})" for kw in self.keywords))
+            if self.keywords
+            else None
+        )
+        self._keyword_patterns = [(kw, re.compile(kw)) for kw in self.keywords]
+        self.fragment_re = (
+            re.compile("|".join(re.escape(f) for f in self.domain_fragments))
+            if self.domain_fragments
+            else None
+        )
+        self.has_sender_rules = bool(self.senders or self.domains or self.fragment_re)
+        return self
+
+    def add(self, kind: str, value: str):
+        # keywords are regexes matched against lowercased text: lowercasing
+        # them here would turn \S, \W, \D, \B into their opposites
+        value = value.strip() if kind == "keyword" else value.strip().lower()
+        if not value:
+            return
+        if kind == "keyword":
+            self.keywords.append(value)
+        elif kind == "sender":
+            self.senders.add(value)
+        elif "." in value:
+            self.domains.add(value)
+        else:
+            self.domain_fragments.append(value)
+
+    def keyword_hits(self, text: str) -> list[str]:
+        if self.keyword_re is None:
+            return []
+        # attribution only runs for matches, which are rare
+        return [self._rule_for(m.group(0)) for m in self.keyword_re.finditer(text)]
+
+    def _rule_for(self, matched: str) -> str:
+        for kw, pattern in self._keyword_patterns:
+            if pattern.fullmatch(matched):
+                return kw
+        return matched
+
+    def sender_hit(self, address: str, domain: str) -> str | None:
+        if not self.has_sender_rules:
+            return None
+        if address and address in self.senders:
+            return address
+        if domain:
+            # a.b.example.com → b.example.com → example.com → com
+            suffix = domain
+            while True:
+                if suffix in self.domains:
+                    return suffix
+                dot = suffix.find(".")
+                if dot < 0:
+                    break
+                suffix = suffix[dot + 1 :]
+            if self.fragment_re is not None:
+                match = self.fragment_re.search(domain)
+                if match:
+                    return match.group(0)
+        return None
+
+
+class JunkRuleEngine:
+    """
+    Compiled junk rules: one keyword alternation, a suffix-matched domain set,
+    plus per-user deny/allow lists. Rules are reloaded from Mongo at most
+    every JUNK_RULES_RELOAD_SECONDS (see refresh()).
+    """
+
+    def __init__(self):
+        self._hits = defaultdict(int)
+        self._loaded_at = 0.0
+        self._reload_lock = asyncio.Lock()
+        self.load_rules([])
+
+    def load_rules(self, rules: list[dict]):
+        """Replace the extra rules (documents as in JUNK_RULES_COLLECTION)."""
+        deny = _RuleSet(keywords=list(SPAM_KEYWORDS))
+        for domain in BAD_DOMAINS:
+            deny.add("domain", domain)
+        allow = _RuleSet()
+        user_deny, user_allow = defaultdict(_RuleSet), defaultdict(_RuleSet)
+
+        for rule in rules:
+            if not rule.get("enabled", True) or not rule.get("value"):
+                continue
+            allowing = rule.get("action") == "allow"
+            user_id = rule.get("user_id")
+            if user_id:
+                target = (user_allow if allowing else user_deny)[str(user_id)]
+            else:
+                target = allow if allowing else deny
+            kind = rule.get("kind", "keyword")
+            value = rule["value"]
+            if kind == "keyword" and user_id:
+                # global keywords are regexes we maintain, user-entered ones are literal
+                value = re.escape(value.strip().lower())
+            elif kind == "keyword":
+                try:
+                    # as it ends up in the alternation, so one bad rule
+                    # doesn't keep every other change from loading
+                    re.compile(f"(?:{value.strip()})")
+                except re.error as e:
+                    print(f"⚠️ Skipping invalid junk keyword rule {value!r}: {e}")
+                    continue
+            target.add(kind, value)
+
+        # swap in one assignment so concurrent scoring sees old or new rules
+        self._rules = (
+            deny.compile(),
+            allow.compile(),
+            {k: v.compile() for k, v in user_deny.items()},
+            {k: v.compile() for k, v in user_allow.items()},
+        )
+
+    async def refresh(self, force: bool = False):
+        """Reload rules from Mongo when they are older than the reload interval."""
+        if not force and time.monotonic() - self._loaded_at < JUNK_RULES_RELOAD_SECONDS:
+            return
+        async with self._reload_lock:
+            if not force and time.monotonic() - self._loaded_at < JUNK_RULES_RELOAD_SECONDS:
+                return
+            from database.mongo import db
+
+            try:
+                rules = await db[JUNK_RULES_COLLECTION].find({}).to_list(length=None)
+                self.load_rules(rules)
+            except Exception as e:
+                print(f"⚠️ Could not reload junk rules, keeping the current set: {e}")
+            self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _text(email: dict) -> str:
+        body = email.get("body") or email.get("snippet") or ""
+        return f"{email.get('subject') or ''} {body}".lower()
+
+    def score(self, email: dict, user_id: str | None = None) -> JunkVerdict:
+        """Score one email ({subject, sender, snippet or body})."""
+        return self._record(self._score(email, self._text(email), user_id, self._rules))
+
+    def score_batch(self, emails: list[dict], user_id: str | None = None) -> list[JunkVerdict]:
+        """
+        Score many emails against one snapshot of the rules. Hits are not
+        counted in stats(): the emails are scored again one by one later.
+        """
+        rules = self._rules
+        # each text is scanned on its own, so verdicts match score()
+        return [self._score(email, self._text(email), user_id, rules) for email in emails]
+
+    def _score(self, email, text, user_id, rules) -> JunkVerdict:
+        deny, allow, user_deny, user_allow = rules
+        subject = email.get("subject") or ""
+        address, domain = parse_sender(email.get("sender", ""))
+
+        if user_id is not None:
+            lists = user_allow.get(str(user_id))
+            if lists and lists.sender_hit(address, domain):
+                return JunkVerdict(False, ("allow:user",))
+        if allow.sender_hit(address, domain):
+            return JunkVerdict(False, ("allow:global",))
+
+        hits = [f"keyword:{kw}" for kw in deny.keyword_hits(text)]
+        sender = deny.sender_hit(address, domain)
+        if sender:
+            hits.append(f"domain:{sender}")
+        if user_id is not None:
+            lists = user_deny.get(str(user_id))
+            if lists:
+                hits += [f"user_keyword:{kw}" for kw in lists.keyword_hits(text)]
+                sender = lists.sender_hit(address, domain)
+                if sender:
+                    hits.append(f"user_sender:{sender}")
+        if text.count("http") > MAX_LINKS:
+            hits.append("too_many_links")
+        if subject.isupper() and len(subject.split()) > 3:
+            hits.append("all_caps_subject")
+
+        return JunkVerdict(bool(hits), tuple(hits))
+
+    def _record(self, verdict: JunkVerdict) -> JunkVerdict:
+        for hit in verdict.hits:
+            self._hits[hit] += 1
+        return verdict
+
+    def stats(self) -> dict:
+        return dict(sorted(self._hits.items(), key=lambda item: -item[1]))
+
+
+junk_engine = JunkRuleEngine()
+
+
+def is_junk_email(input_text: str, user_id: str | None = None) -> bool:
+    return junk_engine.score(parse_input_text(input_text), user_id).is_junk
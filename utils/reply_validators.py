@@ -0,0 +1,139 @@
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+
+# Cheap, deterministic checks that run before the LLM output guardrails.
+# A certain answer (approve/reject) skips the guardrail agent entirely;
+# anything ambiguous escalates to it.
+APPROVE = "approve"
+REJECT = "reject"
+ESCALATE = "escalate"
+
+GREETING_RE = re.compile(
+    r"^(hi|hello|hey|dear|greetings|good (morning|afternoon|evening))\b", re.IGNORECASE
+)
+CLOSING_RE = re.compile(
+    r"^(best regards|kind regards|warm regards|warmest regards|regards|best|"
+    r"sincerely|cheers|many thanks|thanks|thank you)\b[\s,.!]*",
+    re.IGNORECASE,
+)
+SUBJECT_HEADER_RE = re.compile(r"^\s*subject\s*:", re.IGNORECASE | re.MULTILINE)
+FILLER_RE = re.compile(
+    r"as an ai|ai language model|i'?m (just )?an ai|okay,? i'?m ready|"
+    r"i will assist you|i can help you with",
+    re.IGNORECASE,
+)
+# usually the model introducing its output, but also "here is the draft
+# agenda you asked for" in a real reply
+PREAMBLE_RE = re.compile(
+    r"here(?:'s| is) (?:a|the|your) (?:draft|reply|follow-?up)", re.IGNORECASE
+)
+PLACEHOLDER_RE = re.compile(r"\[(?:name|your name|company|sender|recipient)[^\]]*\]", re.IGNORECASE)
+FOLLOWUP_CUE_RE = re.compile(
+    r"follow(?:ing)?[- ]?up|circling back|checking in|touch(?:ing)? base|"
+    r"my (?:last|previous|earlier|recent) (?:email|note|message)|"
+    r"i (?:reached|wrote) out|reaching out again|wanted to bump",
+    re.IGNORECASE,
+)
+
+# (guardrail, verdict) -> count; "llm" verdicts are recorded by the callers
+_stats = defaultdict(int)
+
+
+@dataclass(frozen=True)
+class ValidationResult:
+    verdict: str
+    reasons: tuple[str, ...] = ()
+
+
+def _lines(text: str) -> list[str]:
+    return [line.strip() for line in text.strip().splitlines() if line.strip()]
+
+
+def _first_name(name: str | None) -> str:
+    parts = (name or "").split()
+    return parts[0].lower() if parts else ""
+
+
+def _record(guardrail: str, result: ValidationResult) -> ValidationResult:
+    _stats[(guardrail, result.verdict)] += 1
+    return result
+
+
+def record_llm_verdict(guardrail: str, passed: bool):
+    _stats[(guardrail, "llm_pass" if passed else "llm_trip")] += 1
+
+
+def validate_reply(
+    text: str,
+    signature_name: str | None = None,
+    sender_name: str | None = None,
+    guardrail: str = "reply",
+) -> ValidationResult:
+    """
+    No "Subject:" header, no AI filler and no template placeholders are
+    certain failures and reject. Greeting, closing, signature and sender
+    name are approved when they match and escalated otherwise, since a
+    reply can open or sign off in ways the patterns don't know; so is
+    anything that reads like "here is the draft".
+    """
+    if not isinstance(text, str) or not text.strip():
+        return _record(guardrail, ValidationResult(REJECT, ("empty reply",)))
+
+    lines = _lines(text)
+    reasons = []
+    if SUBJECT_HEADER_RE.search(text):
+        reasons.append("contains a Subject: header")
+    if FILLER_RE.search(text):
+        reasons.append("contains assistant filler")
+    if PLACEHOLDER_RE.search(text):
+        reasons.append("contains a template placeholder")
+    if reasons:
+        return _record(guardrail, ValidationResult(REJECT, tuple(reasons)))
+
+    uncertain = []
+    if PREAMBLE_RE.search(text):
+        uncertain.append("may start with an assistant preamble")
+    if not GREETING_RE.match(lines[0]):
+        uncertain.append("no greeting")
+
+    tail = lines[-4:]
+    closing_at = next((i for i, line in enumerate(tail) if CLOSING_RE.match(line)), None)
+    if closing_at is None:
+        uncertain.append("no closing")
+
+    signature = _first_name(signature_name)
+    if signature:
+        signed = " ".join(tail[closing_at or 0 :]).lower()
+        if signature not in signed:
+            uncertain.append("signature name not found after closing")
+
+    sender = _first_name(sender_name)
+    if sender and sender != "there" and sender not in lines[0].lower():
+        uncertain.append("greeting does not use the sender's name")
+
+    if uncertain:
+        return _record(guardrail, ValidationResult(ESCALATE, tuple(uncertain)))
+    return _record(guardrail, ValidationResult(APPROVE))
+
+
+def validate_followups(text: str, guardrail: str = "followups") -> ValidationResult:
+    """Reject empty/filler output, approve when it clearly reads as a follow-up."""
+    if not isinstance(text, str) or not text.strip():
+        return _record(guardrail, ValidationResult(REJECT, ("empty output",)))
+    if FILLER_RE.search(text):
+        return _record(guardrail, ValidationResult(REJECT, ("contains assistant filler",)))
+    if PLACEHOLDER_RE.search(text):
+        return _record(guardrail, ValidationResult(REJECT, ("contains a template placeholder",)))
+    if PREAMBLE_RE.search(text):
+        return _record(guardrail, ValidationResult(ESCALATE, ("may start with an assistant preamble",)))
+    if FOLLOWUP_CUE_RE.search(text):
+        return _record(guardrail, ValidationResult(APPROVE))
+    return _record(guardrail, ValidationResult(ESCALATE, ("no follow-up cue found",)))
+
+
+def validator_stats() -> dict:
+    summary = defaultdict(dict)
+    for (guardrail, verdict), count in _stats.items():
+        summary[guardrail][verdict] = count
+    return dict(summary)
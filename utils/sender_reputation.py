@@ -0,0 +1,336 @@
+"""
+Per-user sender reputation.
+
+Decayed junk/easy/hard counts per sender address and per sender domain, one
+small document each in SENDER_REPUTATION_COLLECTION, with an LRU cache in
+front. When a sender's history is strongly one-sided (always junk, or always
+hard) `process_email` routes the email without running the LLM. Easy is
+never short-circuited, the reply needs the LLM anyway.
+
+Counts are updated as decisions are made; decisions that came from the
+reputation itself or from the bulk header filter are not recorded, so a
+sender whose behaviour changes decays back below the thresholds and goes
+through the full pipeline again. A junk domain never trashes mail from an
+address of that domain with no history of its own, it goes to review.
+
+    python -m utils.sender_reputation rebuild [--user-id ID]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from dotenv import load_dotenv
+from utils.bulk_mail_filter import is_bulk_reason
+from utils.regex_junk_detection import parse_sender
+from utils.singleflight import SingleFlight
+
+load_dotenv()
+
+SENDER_REPUTATION = os.getenv("SENDER_REPUTATION", "true").lower() == "true"
+SENDER_REPUTATION_COLLECTION = os.getenv("SENDER_REPUTATION_COLLECTION", "sender_reputation")
+SENDER_REPUTATION_HALF_LIFE_DAYS = float(os.getenv("SENDER_REPUTATION_HALF_LIFE_DAYS", "30"))
+# documents untouched this long have decayed to nothing, let Mongo drop them
+SENDER_REPUTATION_TTL_DAYS = int(os.getenv("SENDER_REPUTATION_TTL_DAYS", "180"))
+# decayed decisions needed before an address / a domain is trusted
+SENDER_REPUTATION_MIN_COUNT = float(os.getenv("SENDER_REPUTATION_MIN_COUNT", "4"))
+SENDER_REPUTATION_DOMAIN_MIN_COUNT = float(os.getenv("SENDER_REPUTATION_DOMAIN_MIN_COUNT", "10"))
+SENDER_REPUTATION_MIN_SHARE = float(os.getenv("SENDER_REPUTATION_MIN_SHARE", "0.95"))
+SENDER_REPUTATION_CACHE_SIZE = int(os.getenv("SENDER_REPUTATION_CACHE_SIZE", "50000"))
+SENDER_REPUTATION_CACHE_TTL_SECONDS = int(os.getenv("SENDER_REPUTATION_CACHE_TTL_SECONDS", "600"))
+# mailbox providers: their domain says nothing about the sender
+SHARED_DOMAINS = {
+    d.strip()
+    for d in os.getenv(
+        "SENDER_REPUTATION_SHARED_DOMAINS",
+        "gmail.com,googlemail.com,outlook.com,hotmail.com,live.com,yahoo.com,"
+        "icloud.com,me.com,aol.com,proton.me,protonmail.com,gmx.com,yandex.com",
+    ).split(",")
+    if d.strip()
+}
+
+OUTCOMES = ("junk", "easy", "hard")
+# the only outcomes reputation may decide on its own
+SHORT_CIRCUIT = ("junk", "hard")
+REASON_PREFIX = "sender_reputation"
+# hard emails that were easy but whose reply kept failing the guardrail
+GUARDRAIL_FAILED_REASON = "reply_guardrail_failed"
+
+_HALF_LIFE_SECONDS = SENDER_REPUTATION_HALF_LIFE_DAYS * 24 * 3600
+
+
+@dataclass(frozen=True)
+class ReputationVerdict:
+    action: str | None  # "junk" | "hard" | None
+    reason: str = ""
+
+
+def _decay(seconds: float) -> float:
+    return 0.5 ** (max(seconds, 0.0) / _HALF_LIFE_SECONDS)
+
+
+def _decayed(doc: dict, now: datetime) -> dict:
+    factor = _decay((now - doc["updated_at"]).total_seconds())
+    counts = doc.get("counts") or {}
+    return {o: (counts.get(o) or 0.0) * factor for o in OUTCOMES}
+
+
+def sender_keys(user_id, sender: str) -> list[tuple[str, str]]:
+    """[(doc _id, kind)] for the sender's address and, unless shared, domain."""
+    address, domain = parse_sender(sender)
+    keys = []
+    if address:
+        keys.append((f"{user_id}:{address}", "address"))
+    if domain and domain not in SHARED_DOMAINS:
+        keys.append((f"{user_id}:@{domain}", "domain"))
+    return keys
+
+
+def _update_pipeline(outcome: str, user_id: str, now: datetime) -> list:
+    # decay the stored counts to `now` and add this decision, in one update
+    age_ms = {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}
+    factor = {"$pow": [0.5, {"$divide": [age_ms, _HALF_LIFE_SECONDS * 1000]}]}
+    return [
+        {
+            "$set": {
+                "user_id": user_id,
+                **{
+                    f"counts.{o}": {
+                        "$add": [
+                            {"$multiply": [{"$ifNull": [f"$counts.{o}", 0]}, factor]},
+                            1 if o == outcome else 0,
+                        ]
+                    }
+                    for o in OUTCOMES
+                },
+                "updated_at": now,
+            }
+        }
+    ]
+
+
+def _domain_junk(address_counts: dict | None) -> tuple[str, str | None]:
+    """(label, action) for a junk domain, given the address's own counts."""
+    if address_counts is None:
+        # never seen this address: review it instead of trashing it
+        return "domain:junk_new_address", "hard"
+    if round(address_counts["easy"] + address_counts["hard"], 2) > 0:
+        # the user has dealt with this address before, run the pipeline
+        return "domain:junk_known_address", None
+    return "domain:junk", "junk"
+
+
+class SenderReputation:
+    def __init__(self, size: int, ttl_seconds: int):
+        self.size = size
+        self.ttl = ttl_seconds
+        self._entries = OrderedDict()  # doc _id -> (expires_at, doc | None)
+        self._loads = SingleFlight("sender_reputation")
+        self._index_ready = False
+        self._decided = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def collection(self):
+        from database.mongo import db
+
+        return db[SENDER_REPUTATION_COLLECTION]
+
+    async def _ensure_index(self):
+        if self._index_ready:
+            return
+        await self.collection.create_index(
+            "updated_at", expireAfterSeconds=SENDER_REPUTATION_TTL_DAYS * 24 * 3600
+        )
+        self._index_ready = True
+
+    def _cached(self, key: str):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry
+        return None
+
+    def _store(self, key: str, doc: dict | None):
+        self._entries[key] = (time.monotonic() + self.ttl, doc)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    async def _docs(self, keys: list[str]) -> dict:
+        docs, missing = {}, []
+        for key in keys:
+            entry = self._cached(key)
+            if entry:
+                self.hits += 1
+                docs[key] = entry[1]
+            else:
+                missing.append(key)
+        if missing:
+            self.misses += len(missing)
+            # concurrent misses for the same sender share one read
+            docs.update(await self._loads.do("|".join(missing), self._load, missing))
+        return docs
+
+    async def _load(self, keys: list[str]) -> dict:
+        found = {
+            doc["_id"]: doc
+            async for doc in self.collection.find(
+                {"_id": {"$in": keys}}, {"counts": 1, "updated_at": 1}
+            )
+        }
+        for key in keys:
+            self._store(key, found.get(key))
+        return {key: found.get(key) for key in keys}
+
+    async def lookup(self, email: dict, user_id, record: bool = True) -> ReputationVerdict:
+        """
+        Decide junk/hard from the sender's history, or None to run the
+        pipeline. Pre-passes pass record=False so stats() counts each email once.
+        """
+        if not SENDER_REPUTATION or not user_id:
+            return ReputationVerdict(None)
+        keys = sender_keys(user_id, email.get("sender", ""))
+        if not keys:
+            return ReputationVerdict(None)
+        try:
+            docs = await self._docs([key for key, _ in keys])
+        except Exception as e:
+            print(f"⚠️ Sender reputation unavailable: {e}")
+            return ReputationVerdict(None)
+
+        now = datetime.utcnow()
+        address_counts = None
+        for key, kind in keys:
+            doc = docs.get(key)
+            if not doc:
+                continue
+            counts = _decayed(doc, now)
+            if kind == "address":
+                address_counts = counts
+            # rounded, or back-to-back decisions decay to just under the minimum
+            total = round(sum(counts.values()), 2)
+            if total < (SENDER_REPUTATION_MIN_COUNT if kind == "address" else SENDER_REPUTATION_DOMAIN_MIN_COUNT):
+                continue
+            for outcome in SHORT_CIRCUIT:
+                share = counts[outcome]
+                if share / total >= SENDER_REPUTATION_MIN_SHARE:
+                    label = f"{kind}:{outcome}"
+                    if kind == "domain" and outcome == "junk":
+                        label, outcome = _domain_junk(address_counts)
+                        if outcome is None:
+                            return ReputationVerdict(None)
+                    if record:
+                        self._decided[label] += 1
+                    return ReputationVerdict(
+                        outcome,
+                        f"{REASON_PREFIX}:{label} {share:.1f}/{total:.1f}",
+                    )
+            # a mixed address history wins over whatever its domain says
+            return ReputationVerdict(None)
+        return ReputationVerdict(None)
+
+    async def record(self, user_id, sender: str, outcome: str):
+        """Add one junk/easy/hard decision for the sender's address and domain."""
+        if not SENDER_REPUTATION or not user_id or outcome not in OUTCOMES:
+            return
+        keys = sender_keys(user_id, sender)
+        if not keys:
+            return
+        now = datetime.utcnow()
+        try:
+            await self._ensure_index()
+            for key, _ in keys:
+                await self.collection.update_one(
+                    {"_id": key}, _update_pipeline(outcome, str(user_id), now), upsert=True
+                )
+        except Exception as e:
+            print(f"⚠️ Could not update sender reputation: {e}")
+            for key, _ in keys:
+                self._entries.pop(key, None)
+            return
+
+        # apply the same update to cached entries instead of re-reading them
+        for key, _ in keys:
+            entry = self._cached(key)
+            if entry is None:
+                self._entries.pop(key, None)
+                continue
+            counts = _decayed(entry[1], now) if entry[1] else dict.fromkeys(OUTCOMES, 0.0)
+            counts[outcome] += 1
+            self._store(key, {"_id": key, "counts": counts, "updated_at": now})
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "decided": dict(self._decided),
+        }
+
+
+sender_reputation = SenderReputation(SENDER_REPUTATION_CACHE_SIZE, SENDER_REPUTATION_CACHE_TTL_SECONDS)
+
+
+def is_reputation_reason(reason: str | None) -> bool:
+    return bool(reason) and reason.startswith(REASON_PREFIX)
+
+
+# ---------- Offline rebuild from the emails / hard_emails history ----------
+async def load_history(user_id: str | None = None):
+    """Yield (user_id, sender, outcome, created_at) for every recorded decision."""
+    from models.emails import emails
+    from models.hard_email import hard_emails
+
+    query = {"status": {"$in": ["easy", "junk"]}}
+    if user_id:
+        query["user_id"] = user_id
+    async for doc in emails.find(query, {"user_id": 1, "to_email": 1, "status": 1, "reason": 1, "created_at": 1}):
+        reason = doc.get("reason")
+        if not is_reputation_reason(reason) and not is_bulk_reason(reason):
+            yield doc["user_id"], doc.get("to_email", ""), doc["status"], doc.get("created_at")
+
+    query = {"type": "inbound"}
+    if user_id:
+        query["user_id"] = user_id
+    async for doc in hard_emails.find(query, {"user_id": 1, "sender": 1, "reason": 1, "created_at": 1}):
+        reason = doc.get("reason")
+        if not is_reputation_reason(reason) and reason != GUARDRAIL_FAILED_REASON:
+            yield doc["user_id"], doc.get("sender", ""), "hard", doc.get("created_at")
+
+
+async def rebuild(user_id: str | None = None):
+    now = datetime.utcnow()
+    docs = {}
+    async for uid, sender, outcome, created_at in load_history(user_id):
+        weight = _decay((now - created_at).total_seconds()) if created_at else 1.0
+        for key, _ in sender_keys(uid, sender):
+            doc = docs.setdefault(
+                key,
+                {"_id": key, "user_id": str(uid), "counts": dict.fromkeys(OUTCOMES, 0.0), "updated_at": now},
+            )
+            doc["counts"][outcome] += weight
+
+    collection = sender_reputation.collection
+    await collection.delete_many({"user_id": user_id} if user_id else {})
+    docs = list(docs.values())
+    for i in range(0, len(docs), 1000):
+        await collection.insert_many(docs[i : i + 1000], ordered=False)
+    await sender_reputation._ensure_index()
+    print(f"✅ Rebuilt {len(docs)} sender reputation entries")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Maintain the sender reputation index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--user-id", default=None)
+    args = parser.parse_args()
+    await rebuild(args.user_id)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+import asyncio
+from collections import defaultdict
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: while a call for `key` is running,
+    other callers with the same key wait for it and get the same result (or
+    the same exception). Nothing is kept once the call finishes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # key -> running task
+        self._stats = defaultdict(int)
+
+    async def do(self, key: str, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            self._stats["calls"] += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self._stats["shared"] += 1
+        # shielded, so one caller being cancelled doesn't cancel the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # mark the error as retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), **self._stats}
+
+
+llm_flight = SingleFlight("llm")
+serp_flight = SingleFlight("serpapi")
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+
+
+class SyncDispatcher:
+    """
+    Central scheduler for mailbox syncs.
+
+    Registered mailboxes sit in a due-time priority queue. When a mailbox is
+    due it moves to a ready queue (one for pro users, one for free users) and
+    a fixed pool of async workers picks it up. Pro mailboxes are preferred
+    `pro_weight` to 1, so free users are never starved. Every interval is
+    jittered so mailboxes registered together don't stay aligned.
+
+    A mailbox is never synced twice at the same time: a trigger that arrives
+    while its sync is running is folded into one follow-up run.
+    """
+
+    def __init__(self, run_sync, workers: int = 8, jitter: float = 0.1, pro_weight: int = 3):
+        self._run_sync = run_sync
+        self.workers = workers
+        self.jitter = jitter
+        self.pro_weight = pro_weight
+
+        self._mailboxes = {}  # user_id -> {"interval", "is_pro", "next_due"}
+        self._heap = []  # (due, seq, user_id), stale entries are skipped
+        self._seq = itertools.count()
+        self._ready = {"pro": deque(), "free": deque()}
+        self._ready_count = asyncio.Semaphore(0)
+        self._queued = set()
+        self._running = set()
+        self._resync = set()
+        self._pro_streak = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+        self._lags = deque(maxlen=500)
+        self._completed = 0
+        self._failed = 0
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._schedule_loop()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ---------- mailboxes ----------
+    def register(self, user_id: str, interval_seconds: float, is_pro: bool = False):
+        self._mailboxes[user_id] = {
+            "interval": interval_seconds,
+            "is_pro": bool(is_pro),
+            "next_due": None,
+        }
+        self._schedule(user_id)
+
+    def unregister(self, user_id: str) -> bool:
+        self._resync.discard(user_id)
+        return self._mailboxes.pop(user_id, None) is not None
+
+    def is_registered(self, user_id: str) -> bool:
+        return user_id in self._mailboxes
+
+    def trigger(self, user_id: str) -> bool:
+        """Sync a registered mailbox as soon as a worker is free."""
+        if user_id not in self._mailboxes:
+            return False
+        if user_id in self._running:
+            self._resync.add(user_id)
+        else:
+            self._enqueue(user_id, time.monotonic())
+        return True
+
+    def _schedule(self, user_id: str):
+        box = self._mailboxes.get(user_id)
+        if box is None:
+            return
+        interval = box["interval"]
+        due = time.monotonic() + interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        box["next_due"] = due
+        heapq.heappush(self._heap, (due, next(self._seq), user_id))
+        self._wakeup.set()
+
+    def _enqueue(self, user_id: str, due: float):
+        if user_id in self._queued or user_id in self._running:
+            return
+        tier = "pro" if self._mailboxes[user_id]["is_pro"] else "free"
+        self._ready[tier].append((user_id, due))
+        self._queued.add(user_id)
+        self._ready_count.release()
+
+    def _pick(self):
+        pro, free = self._ready["pro"], self._ready["free"]
+        if pro and (self._pro_streak < self.pro_weight or not free):
+            self._pro_streak += 1
+            return pro.popleft()
+        self._pro_streak = 0
+        return free.popleft()
+
+    # ---------- loops ----------
+    async def _schedule_loop(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, user_id = heapq.heappop(self._heap)
+                box = self._mailboxes.get(user_id)
+                if box is None or box["next_due"] != due:
+                    continue
+                self._enqueue(user_id, due)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            await self._ready_count.acquire()
+            user_id, due = self._pick()
+            self._queued.discard(user_id)
+            if user_id not in self._mailboxes:
+                continue
+
+            self._lags.append(max(0.0, time.monotonic() - due))
+            self._running.add(user_id)
+            try:
+                await self._run_sync(user_id)
+                self._completed += 1
+            except Exception as e:
+                self._failed += 1
+                print(f"❌ Sync failed for {user_id}: {e}")
+            finally:
+                self._running.discard(user_id)
+
+            if user_id in self._resync:
+                self._resync.discard(user_id)
+                self._enqueue(user_id, time.monotonic())
+            else:
+                self._schedule(user_id)
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        lags = sorted(self._lags)
+        p95 = lags[min(len(lags) - 1, int(len(lags) * 0.95))] if lags else 0.0
+        return {
+            "mailboxes": len(self._mailboxes),
+            "queue_depth": {
+                "pro": len(self._ready["pro"]),
+                "free": len(self._ready["free"]),
+            },
+            "running": len(self._running),
+            "workers": self.workers,
+            "lag_seconds": {
+                "last": self._lags[-1] if self._lags else 0.0,
+                "avg": sum(lags) / len(lags) if lags else 0.0,
+                "p95": p95,
+                "max": lags[-1] if lags else 0.0,
+            },
+            "completed": self._completed,
+            "failed": self._failed,
+        }